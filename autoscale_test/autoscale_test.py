@@ -5,85 +5,419 @@ import sys
 import argparse
 import json
 import time
+import glob
+import numpy
+import threading
 
-from random import sample
-from multiprocessing import Pool
+from random import sample, seed
+from contextlib import contextmanager
+from itertools import islice
+from multiprocessing import Process, Queue, Value
 from multiprocessing.pool import ThreadPool
+from queue import Empty
 from boto3.session import Session
+from botocore.client import Config
 
-from cutouts import gen_urls, gen_results
-from resources import create_queue, create_role, create_lambda
-from processes import launch_lambda, aggregate
+from cutouts import gen_urls, gen_results, gen_stream, parse_endpoints, cutout_share, DISTRIBUTIONS, ORIENTATIONS
+from resources import create_resources, persistent_resources, teardown
+from processes import launch_lambda, aggregate, local_worker, load_worker
+from stats import Stats, Timeline
+from profiles import parse_profile, peak, duration
+from report import print_report, LiveConsole
+from controller import Controller
+from traces import read_trace, write_trace, trace_from_records
 
-def dup(count, *args):
-    results = []
-    for i in range(count):
-        results.append(args)
-    return results
+SQS_BATCH_SIZE = 10 # Maximum number of entries in a single SQS batch request
+REPORT_WINDOWS = 2000 # Windows kept in the report timeline, past that they are widened
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i+size]
+
+def enqueue_batch(client, queue_url, batch, retry=3):
+    entries = [{'Id': str(i), 'MessageBody': body} for i, body in enumerate(batch)]
+    delay = 0.1
+    while True:
+        resp = client.send_message_batch(QueueUrl = queue_url, Entries = entries)
+        failed = set(f['Id'] for f in resp.get('Failed', []))
+        entries = [entry for entry in entries if entry['Id'] in failed]
+        if len(entries) == 0 or retry == 0:
+            break
+        # Partial failure, back off and resend only the failed entries
+        retry -= 1
+        time.sleep(delay)
+        delay *= 2
+    return len(batch) - len(entries)
+
+@contextmanager
+def message_sender(url_queue, threads=10):
+    """Yields send(bodies), which queues the bodies in batches over a thread pool
+    and returns an iterator over the number queued of each batch"""
+    # Boto3 clients are thread safe, the queue resource is not
+    client = url_queue.meta.client
+    def send_batch(batch):
+        return enqueue_batch(client, url_queue.url, batch)
+
+    pool = ThreadPool(processes = threads)
+    try:
+        yield lambda bodies: pool.imap_unordered(send_batch, chunks(bodies, SQS_BATCH_SIZE))
+    finally:
+        pool.terminate()
+
+def enqueue_messages(url_queue, results, threads=10):
+    sent = 0
+    start = time.time()
+    with message_sender(url_queue, threads) as send:
+        for i, count in enumerate(send(results)):
+            sent += count
+            print("{:7.2%} Queuing URLs\r".format(i * SQS_BATCH_SIZE / len(results)), end='')
+    elapsed = time.time() - start
 
-def enqueue_messages(url_queue, results):
-    for i in range(len(results)):
-        url_queue.send_message(MessageBody = results[i])
-        print("{:7.2%} Queuing URLs\r".format(i/len(results)), end='')
     print("Finished queuing urls           ")
+    if sent < len(results):
+        print("\tFailed to queue {:,} urls".format(len(results) - sent))
+    if elapsed > 0:
+        print("\tQueued {:,} messages in {:.2f} seconds ({:,.0f} messages/sec)".format(sent, elapsed, sent / elapsed))
+
+def queue_depth(client, queue_url):
+    attributes = client.get_queue_attributes(QueueUrl = queue_url,
+                                             AttributeNames = ['ApproximateNumberOfMessages'])['Attributes']
+    return int(attributes['ApproximateNumberOfMessages'])
+
+def stream_messages(url_queue, bodies, depth, stop, threads=10, interval=1):
+    """Keep about depth messages on the URL queue, taking more from the bodies iterator as it drains"""
+    client = url_queue.meta.client
+    with message_sender(url_queue, threads) as send:
+        while not stop.wait(interval):
+            missing = depth - queue_depth(client, url_queue.url)
+            if missing <= 0:
+                continue
+            batch = list(islice(bodies, missing))
+            if len(batch) == 0:
+                break # Every URL has been queued
+            for count in send(batch):
+                pass
+
+def schedule_messages(url_queue, bodies, offsets, start, lead, stop, threads=10, interval=1):
+    """Queue each message lead seconds before start + its offset (sorted), so no worker holds it for long"""
+    with message_sender(url_queue, threads) as send:
+        queued = 0
+        while queued < len(bodies):
+            due = int(numpy.searchsorted(offsets, time.time() - start + lead, side = 'right'))
+            for count in send(bodies[queued:due]):
+                pass
+            queued = due
+            if stop.wait(interval):
+                break
+
+def invoke_lambdas(client, args, count, rate=None, threads=10):
+    # Worker i is scheduled to launch at start + i / rate, so the ramp is the
+    # same from run to run no matter how long each invoke call takes
+    start = time.time()
+    def invoke(i):
+        if rate:
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        launched = time.time()
+        payload = dict(args, worker = i, launched = launched)
+        client.invoke(FunctionName = 'AutoScaleTest',
+                      InvocationType = 'Event',
+                      Payload = json.dumps(payload).encode('utf-8'))
+        return (i, launched)
+
+    pool = ThreadPool(processes = threads)
+    launches = {}
+    try:
+        for worker, launched in pool.imap_unordered(invoke, range(count)):
+            launches[worker] = launched
+            print("{:7.2%} Launching Lambdas\r".format(len(launches)/count), end='')
+    finally:
+        pool.terminate()
+    elapsed = time.time() - start
 
-def invoke_lambdas(args, count):
-    for i in range(count):
-        resp = client.invoke(FunctionName = 'AutoScaleTest',
-                             InvocationType = 'Event',
-                             Payload = json.dumps(args).encode('utf-8'))
-        print("{:7.2%} Launching Lambdas\r".format(i/count), end='')
     print("Finished launching lambdas          ")
+    if elapsed > 0:
+        print("\tLaunched {:,} lambdas in {:.2f} seconds ({:,.1f} lambdas/sec)".format(count, elapsed, count / elapsed))
+    return launches
+
+def relaunch_lambdas(client, args, count, interval, finished, stop, rate=None, threads=10):
+    """Launch the next set of lambdas every interval seconds, until finished() returns True"""
+    while not stop.wait(interval):
+        if finished():
+            break
+        invoke_lambdas(client, dict(args, relaunched = True), count, rate, threads)
+
+def write_launches(filename, launches):
+    with open(filename, 'w') as fh:
+        json.dump({str(worker): launched for worker, launched in sorted(launches.items())}, fh, indent=4)
 
-def poll_messages(session_args, queue, lambda_count, total_count):
-    pool = Pool(processes = min(lambda_count, 10))
-    
-    total_bytes = 0
-    total_seconds = 0
+def records_file(output_dir, i):
+    if output_dir is None:
+        return None
+    return os.path.join(output_dir, 'records-{}.jsonl'.format(i))
+
+def poll_messages(session_args, queue, lambda_count, total_count, idle_timeout=60, output_dir=None,
+                  window=10, profile=None, start=None, records=True, controller=None):
+    results = Queue()
+    received = Value('i', 0)
+    aggregators = [Process(target = aggregate,
+                           args = (queue.url, session_args, results, received, total_count, idle_timeout),
+                           kwargs = {'records': records_file(output_dir, i) if records else None,
+                                     'window': window})
+                   for i in range(min(lambda_count, 10))]
+    # Results are batched by the lambdas before they are sent
+    collect(aggregators, results, total_count, output_dir, window, profile, start, live_delay = 5,
+            controller = controller)
+
+def collect(processes, results, total_count, output_dir=None, window=10, profile=None, start=None,
+            live_delay=2, controller=None):
+    # Each process puts (Stats, Timeline, live Timeline) tuples on the
+    # results queue as it goes and None once it has finished
+    stats = Stats()
+    timeline = Timeline(window, REPORT_WINDOWS)
+    console = LiveConsole(window, live_delay)
     total_time = 0
-    received_count = 0
-    errors = []
     try:
-        start = time.time()
-        print("Waiting for messages", end='', flush=True)
-
-        while received_count < total_count:
-            results = pool.starmap(aggregate, dup(pool._processes, queue.url, session_args, 60))
-            for count, (bytes_, seconds), errors_ in results:
-                received_count += count
-                total_bytes += bytes_
-                total_seconds += seconds
-                errors.extend(errors_)
-            print("\nReceived {} messages".format(received_count), flush=True)
+        collect_start = time.time()
+        print("Waiting for messages", flush=True)
+        for process in processes:
+            process.start()
+        if controller is not None:
+            controller.start()
+
+        running = len(processes)
+        while running > 0:
+            console.update(stats.count)
+            if controller is not None:
+                controller.update()
+            try:
+                result = results.get(timeout = 1)
+            except Empty:
+                # Stop waiting if a process died without signaling that it finished
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            if result is None:
+                running -= 1
+                continue
 
+            stats.merge(result[0])
+            timeline.merge(result[1])
+            console.merge(result[2])
+            if controller is not None:
+                controller.merge(result[2])
+
+        console.update(stats.count, force = True)
+        print()
+        if stats.count < total_count:
+            print("Only received {:,} of {:,} results".format(stats.count, total_count))
         print("Finished waiting for messages", flush=True)
         print()
-        total_time = time.time() - start
+        total_time = time.time() - collect_start
     except KeyboardInterrupt:
         pass
     finally:
-        pool.terminate()
+        for process in processes:
+            process.terminate()
         # Always print, even if there was a CTRL+C
         print()
-        print("Elapsed time: {} seconds".format(total_time))
-        print("Received {:,} messages".format(received_count))
-        print("Number of errors {:,}".format(len(errors)))
-        keys = set(errors)
-        values = list(errors)
-        for key in keys:
-            print("\t{} x '{}'".format(values.count(key), key))
-        if total_seconds == 0:
-            print("Zero seconds of data recorded")
-        else:
-            rate = total_bytes / total_seconds
-            units = 'b/s'
-            for unit in ['Kb/s', 'Mb/s', 'Gb/s', 'Tb/s']:
-                if rate > 1024:
-                    rate = rate / 1024
-                    units = unit
-
-            print("Throughput {:,} {}".format(int(rate), units))
-        print()
+        print_report(stats, timeline, total_time, output_dir, profile, start, controller)
+
+def control_timing(args):
+    """(delay, settle) of the adaptive controller's steps, in seconds
+
+    Results arrive up to delay seconds after they complete. On the lambda
+    backend each set of lambdas runs up to delay seconds into the next step,
+    so there is no gap while the next set launches, and its last requests
+    finish after that. Steps are only judged after settle seconds, once just
+    the new set is running.
+    """
+    if args.backend == 'lambda':
+        delay = 5 + (load_worker().SUMMARY_INTERVAL if args.summaries else 0)
+        return delay, max(args.control_interval / 3, 2 * delay)
+    return 2, args.control_interval / 3
+
+def make_controller(args, scale, minimum, maximum):
+    delay, settle = control_timing(args)
+    return Controller(scale, args.slo, args.max_error_rate, args.increase or args.threads, args.decrease,
+                      args.control_interval, minimum, maximum, delay, settle)
+
+def make_output_dir(output):
+    # Same layout as the system tests, one timestamped directory per run
+    start_time = time.gmtime()
+    output_dir = os.path.join(output, time.strftime('%Y_%m_%d_%H_%M_%S', start_time))
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+def load_session_args(credentials):
+    creds = json.load(credentials)
+    return {
+        'aws_access_key_id' : creds['aws_access_key'],
+        'aws_secret_access_key' : creds['aws_secret_key'],
+        'region_name' : creds.get('aws_region', 'us-east-1'),
+    }
+
+def run_lambda(args, results, output_dir):
+    session_args = load_session_args(args.aws_credentials)
+    session = Session(**session_args)
+
+    print("Creating AWS Resources")
+    # A single client is shared by all of the launch threads
+    client = session.client('lambda', config = Config(max_pool_connections = args.launch_threads))
+    resources = persistent_resources if args.persistent else create_resources
+    stop = threading.Event() # Stops the streaming producer and relaunching
+    try:
+        lambda_timeout = 60 * 5
+        with resources(session, lambda_timeout) as (queue, url_queue, target):
+            print("\tComplete")
+
+            start = None
+            producer = None
+            if args.trace is not None:
+                # The send time of each replayed request travels with its URL.
+                # Requests are queued as they come due instead of all at once,
+                # or they would wait past the visibility timeout in the lambdas.
+                offsets, workers = args.trace
+                results = [json.dumps({'url': url, 'offset': offset})
+                           for url, offset in zip(results, offsets.tolist())]
+                start = time.time()
+                producer = threading.Thread(target = schedule_messages,
+                                            args = (url_queue, results, offsets, start, load_worker().PREFETCH_SECONDS,
+                                                    stop, args.enqueue_threads))
+                producer.daemon = True
+                producer.start()
+                print("Queuing the trace's requests as they come due")
+            elif args.queue_depth:
+                # Fill the queue to the target depth, then keep it topped up as the lambdas drain it
+                results = iter(results)
+                enqueue_messages(url_queue, list(islice(results, args.queue_depth)), args.enqueue_threads)
+                producer = threading.Thread(target = stream_messages,
+                                            args = (url_queue, results, args.queue_depth, stop, args.enqueue_threads))
+                producer.daemon = True
+                producer.start()
+            else:
+                enqueue_messages(url_queue, results, args.enqueue_threads)
+
+            if start is None:
+                start = time.time()
+            lambda_args = {
+                'token': args.token,
+                'queue': queue.url,
+                'input': url_queue.url,
+                'threads': args.threads,
+                'rate': args.rate / args.lambdas if args.rate else None,
+                'profile': args.profile,
+                'start': start,
+                'decode': args.decode,
+                'summaries': args.summaries,
+                'window': args.window,
+            }
+            if args.trace is not None and len(results) > 0:
+                lambda_args['until'] = start + float(offsets[-1]) # The last request is queued by then
+            controller = None
+            if args.slo:
+                # The controller launches a new set of lambdas every step, each
+                # running until a little after the step has been judged so
+                # there is no gap while the next set launches
+                delay, settle = control_timing(args)
+                def scale(concurrency):
+                    count = -(-concurrency // args.threads)
+                    stop = time.time() + args.control_interval + 2 * delay
+                    invoke_lambdas(client, dict(lambda_args, stop = stop), count,
+                                   args.launch_rate, args.launch_threads)
+                    return count * args.threads
+                controller = make_controller(args, scale, 1, args.max_concurrency or args.lambdas * args.threads)
+            else:
+                launches = invoke_lambdas(client, lambda_args, args.lambdas,
+                                          args.launch_rate, args.launch_threads)
+                if args.launches:
+                    write_launches(args.launches, launches)
+            if args.queue_depth or args.profile or args.rate or args.trace is not None:
+                # Each lambda stops receiving TIMEOUT_MARGIN before its timeout,
+                # so a streamed, open loop or replayed run or a load profile can
+                # last longer than a single lambda. The next set continues the
+                # profile or trace from start, or the open loop schedule where
+                # the last set's prefetched requests end.
+                def finished():
+                    if args.profile:
+                        return time.time() - start >= duration(args.profile)
+                    if producer is not None and producer.is_alive():
+                        return False
+                    return queue_depth(url_queue.meta.client, url_queue.url) == 0
+                relauncher = threading.Thread(target = relaunch_lambdas,
+                                              args = (client, lambda_args, args.lambdas, lambda_timeout - 30,
+                                                      finished, stop, args.launch_rate, args.launch_threads))
+                relauncher.daemon = True
+                relauncher.start()
+
+            poll_messages(session_args, queue, args.lambdas, args.total, args.idle_timeout,
+                          output_dir, args.window, args.profile, start, not args.summaries, controller)
+
+            if not args.persistent:
+                input("Press any key to cleanup")
+    finally:
+        stop.set()
+        if not args.persistent:
+            print("Waiting 60 seconds for queue to be deleted")
+            time.sleep(60)
+
+def run_local(args, results, output_dir):
+    # Split the URLs between the worker processes, each process then makes
+    # requests from its share on args.threads threads
+    count = max(min(args.processes, len(results)), 1)
+    headers = load_worker().request_headers(args.token)
+    threads = args.threads
+    if args.profile:
+        # Enough threads between the processes for the profile's peak concurrency
+        threads = -(-peak(args.profile) // count)
+
+    controller = None
+    limit = None
+    if args.slo:
+        # Enough threads for the highest concurrency the controller may set,
+        # which then only lets the first limit of them make requests. Each
+        # process keeps at least one, as the URLs are split between them.
+        maximum = max(args.max_concurrency or count * threads, count)
+        threads = -(-maximum // count)
+        limit = Value('i', 0)
+        def scale(concurrency):
+            limit.value = concurrency
+            return concurrency
+        controller = make_controller(args, scale, count, maximum)
+
+    # In open loop mode the processes share one schedule, process i sends
+    # requests i, i + count, i + 2 * count, ... of it. A replayed trace keeps
+    # each request on the same worker, folded onto the available processes.
+    start = time.time() + 1 # Give the processes time to start
+    def work(i):
+        if args.trace is not None:
+            offsets, workers = args.trace
+            share = numpy.flatnonzero(workers % count == i)
+            return [results[j] for j in share], {'start': start, 'offsets': offsets[share]}
+        if args.rate:
+            return results[i::count], {'start': start, 'offsets': numpy.arange(i, len(results), count) / args.rate}
+        if args.profile:
+            return results[i::count], {'start': start, 'profile': args.profile}
+        return results[i::count], {}
+
+    queue = Queue()
+    workers = []
+    for i in range(count):
+        urls, schedule = work(i)
+        workers.append(Process(target = local_worker,
+                               args = (i, urls, headers, threads, queue),
+                               kwargs = dict(schedule, window = args.window, decode = args.decode,
+                                             processes = count, limit = limit,
+                                             records = None if args.summaries else records_file(output_dir, i))))
+    collect(workers, queue, len(results), output_dir, args.window, args.profile, start,
+            controller = controller)
+
+BACKENDS = {
+    'lambda': run_lambda,
+    'local': run_local,
+}
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = "BOSS API Autoscale Test Script",
@@ -102,66 +436,194 @@ if __name__ == '__main__':
     parser.add_argument("--min", type=int, help = "Minimum cutout size")
     parser.add_argument("--max", type=int, help = "Maximum cutout size")
     parser.add_argument("--unique", "-u", type=int, help = "Number of channels to target")
+    parser.add_argument("--discovery-threads", default=10, type=int, help = "Number of threads used to look up the target channels")
+    parser.add_argument("--cache",
+                        default = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'output', 'catalog.json'),
+                        help = "File to cache the target channel catalog in")
+    parser.add_argument("--cache-ttl", default=3600, type=int, help = "Seconds the cached channel catalog is used for (0 to disable)")
     parser.add_argument("--total", "-t", default=100, type=int, help = "Total number of requests to make")
+    parser.add_argument("--seed", "-s", type=int, help = "Random seed, to generate the same requests in every run")
+    parser.add_argument("--distribution", "-d", default='uniform', choices=sorted(DISTRIBUTIONS),
+                        help = "Spatial distribution of the cutouts: uniform random boxes, boxes aligned to the cuboid grid, "
+                               "Zipf weighted hot regions or raster sweeps")
+    parser.add_argument("--reuse", default=0.0, type=float, help = "Fraction of requests that repeat an earlier cutout (0 - 1)")
+    parser.add_argument("--endpoints", default='cutout',
+                        help = "Request mix, weights of the cutout, tile and image endpoints like 'cutout:1,tile:3,image:1'")
+    parser.add_argument("--orientation", default='xy', choices=ORIENTATIONS, help = "Plane of the tile and image requests")
+    parser.add_argument("--tile-size", default=512, type=int, help = "Size of the tile requests")
+    parser.add_argument("--writes", default=0.0, type=float,
+                        help = "Fraction of all requests that POST a blosc cuboid instead of reading a cutout "
+                               "(0 - 1, at most the cutout share of --endpoints)")
+    parser.add_argument("--hotspots", default=10, type=int, help = "Number of hot regions per channel (hotspot distribution)")
+    parser.add_argument("--zipf", default=1.1, type=float, help = "Zipf exponent of the hot region popularity (hotspot distribution)")
+    parser.add_argument("--backend", "-b", default='lambda', choices=sorted(BACKENDS),
+                        help = "Where to run the requests from, AWS Lambda or processes on this machine")
+    parser.add_argument("--persistent", action = "store_true",
+                        help = "Keep the AWS resources between runs, reusing them and only updating the lambda code when it changes")
+    parser.add_argument("--teardown", action = "store_true",
+                        help = "Delete the AWS resources kept by --persistent, or left behind by an interrupted run, and exit")
     parser.add_argument("--lambdas", "-l", default=5, type=int, help = "Total number of lambdas to create")
-    parser.add_argument("token", help="BOSS API Token")
-    parser.add_argument("hostname", help="Pulic hostname of the target BOSS API server")
+    parser.add_argument("--processes", "-p", default=os.cpu_count(), type=int, help = "Number of local worker processes (local backend)")
+    parser.add_argument("--threads", default=4, type=int, help = "Number of concurrent requests made by each lambda or local process")
+    parser.add_argument("--decode", action = "store_true",
+                        help = "Decompress each response and record the decode time (needs the blosc package, which the lambda does not have)")
+    parser.add_argument("--rate", "-r", type=float,
+                        help = "Open loop mode, send requests at this total rate (requests/sec) instead of as fast as responses return")
+    parser.add_argument("--profile",
+                        help = "Load profile, JSON file or stages like 'ramp:10:500:600,hold:500:60,spike:1000:30' (see profiles.py)")
+    parser.add_argument("--slo", type=float,
+                        help = "p99 latency SLO (seconds), adjusts the concurrency to find the highest throughput that meets it")
+    parser.add_argument("--max-error-rate", default=0.01, type=float,
+                        help = "Highest fraction of failed requests that still meets the SLO (with --slo)")
+    parser.add_argument("--increase", type=int,
+                        help = "Concurrent requests added after a step that met the SLO (with --slo, default: --threads)")
+    parser.add_argument("--decrease", default=0.5, type=float,
+                        help = "Factor the concurrency is multiplied by after a step that did not (with --slo)")
+    parser.add_argument("--control-interval", default=30, type=int, help = "Length of each --slo step (seconds)")
+    parser.add_argument("--max-concurrency", type=int,
+                        help = "Highest concurrency --slo may reach (default: --lambdas or --processes x --threads)")
+    parser.add_argument("--window", default=10, type=int, help = "Width of the report timeline windows (seconds)")
+    parser.add_argument("--record-trace", metavar = "<file>", help = "Save the requests made in this run as a trace file")
+    parser.add_argument("--summaries", action = "store_true",
+                        help = "Workers only send per window summaries of their results, no request records (for very large runs)")
+    parser.add_argument("--replay", metavar = "<file>", help = "Replay the requests in a trace file instead of generating new ones")
+    parser.add_argument("--speed", default=1.0, type=float, help = "Replay speed, 2 replays the trace in half the time")
+    parser.add_argument("--idle-timeout", default=60, type=int, help = "Seconds to wait for new results before giving up")
+    parser.add_argument("--queue-depth", type=int,
+                        help = "Generate the URLs as they are needed and keep about this many on the queue (lambda backend, "
+                               "for long runs), instead of generating and queuing all of them first")
+    parser.add_argument("--enqueue-threads", default=10, type=int, help = "Number of threads used to queue URLs")
+    parser.add_argument("--launch-threads", default=10, type=int, help = "Number of threads used to launch lambdas")
+    parser.add_argument("--launch-rate", type=float, help = "Target lambda launch rate (lambdas/sec, default: as fast as possible)")
+    parser.add_argument("--launches", metavar = "<file>", help = "File to write the launch time of each lambda to")
+    parser.add_argument("--output", "-o",
+                        default = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'output'),
+                        help = "Directory to write the run reports under")
+    parser.add_argument("token", nargs='?', help="BOSS API Token")
+    parser.add_argument("hostname", nargs='?', help="Pulic hostname of the target BOSS API server")
 
     args = parser.parse_args()
 
-    if args.aws_credentials is None:
+    if (args.backend == 'lambda' or args.teardown) and args.aws_credentials is None:
         parser.print_usage()
         print("Error: AWS credentials not provided and AWS_CREDENTIALS is not defined")
         sys.exit(1)
 
-    creds = json.load(args.aws_credentials)
-    session_args = {
-        'aws_access_key_id' : creds['aws_access_key'],
-        'aws_secret_access_key' : creds['aws_secret_key'],
-        'region_name' : creds.get('aws_region', 'us-east-1'),
-    }
-    session = Session(**session_args)
+    if args.teardown:
+        print("Deleting AWS Resources")
+        teardown(Session(**load_session_args(args.aws_credentials)))
+        print("\tComplete")
+        sys.exit(0)
 
-    # Generate the unique target channels
-    print("Generating URLs")
-    urls = gen_urls(args)
-    if len(urls) == 0:
+    if args.token is None or args.hostname is None:
+        parser.print_usage()
+        print("Error: the token and hostname arguments are required")
         sys.exit(1)
-    if args.unique:
-        if args.unique >= len(urls):
-            print("Only {} unique urls, not using --unique argument".format(len(urls)))
-        else:
-            urls = sample(urls, args.unique)
-    if len(urls) > args.total:
-        urls = sample(urls, args.total)
 
-    # Generate unique urls
-    results = gen_results(args.total, urls)
-    print("\tComplete")
+    if args.summaries and args.record_trace:
+        parser.print_usage()
+        print("Error: --record-trace needs the request records, which --summaries does not keep")
+        sys.exit(1)
 
-    print("Creating AWS Resources")
-    client = session.client('lambda')
     try:
-        with create_queue(session, 'AutoScaleTestResults') as queue:
-            with create_queue(session, 'AutoScaleTestUrls') as url_queue:
-                with create_role(session) as role:
-                    lambda_timeout = 60 * 5
-                    with create_lambda(session, role, lambda_timeout) as target:
-                        print("\tComplete")
+        args.endpoints = parse_endpoints(args.endpoints)
+    except ValueError as e:
+        parser.print_usage()
+        print("Error: {}".format(e))
+        sys.exit(1)
 
-                        enqueue_messages(url_queue, results)
+    if not 0 <= args.writes <= cutout_share(args.endpoints):
+        parser.print_usage()
+        print("Error: --writes has to be between 0 and {:g}, the share of cutouts in --endpoints, only cutouts are written".format(
+              cutout_share(args.endpoints)))
+        sys.exit(1)
 
-                        lambda_args = {
-                            'token': args.token,
-                            'queue': queue.url,
-                            'input': url_queue.url,
-                        }
-                        invoke_lambdas(lambda_args, args.lambdas)
+    if args.queue_depth and args.backend != 'lambda':
+        parser.print_usage()
+        print("Error: --queue-depth is only used by the lambda backend")
+        sys.exit(1)
 
-                        poll_messages(session_args, queue, args.lambdas, args.total)
+    if args.queue_depth and args.replay:
+        parser.print_usage()
+        print("Error: --queue-depth cannot be used with --replay, a replay is queued as its requests come due")
+        sys.exit(1)
 
-                        input("Press any key to cleanup")
-    finally:
-        print("Waiting 60 seconds for queue to be deleted")
-        time.sleep(60)
+    if args.slo:
+        if args.rate or args.profile or args.replay or args.queue_depth:
+            parser.print_usage()
+            print("Error: --slo cannot be used with --rate, --profile, --replay or --queue-depth")
+            sys.exit(1)
+        if not 0 < args.decrease < 1 or args.control_interval < 3 or args.control_interval > 180:
+            parser.print_usage()
+            print("Error: --decrease has to be between 0 and 1 and --control-interval between 3 and 180 seconds")
+            sys.exit(1)
+        delay, settle = control_timing(args)
+        if settle > args.control_interval * 2 / 3:
+            parser.print_usage()
+            print("Error: --control-interval has to be at least {:.0f} seconds, steps are judged after settling for {:.0f} seconds".format(
+                  settle * 3 / 2, settle))
+            sys.exit(1)
+
+    if args.replay and (args.rate or args.profile):
+        parser.print_usage()
+        print("Error: --replay cannot be used with --rate or --profile")
+        sys.exit(1)
+
+    if args.profile:
+        if args.rate:
+            parser.print_usage()
+            print("Error: --profile and --rate cannot be used together")
+            sys.exit(1)
+        try:
+            args.profile = parse_profile(args.profile)
+        except ValueError as e:
+            parser.print_usage()
+            print("Error: {}".format(e))
+            sys.exit(1)
+        if args.backend == 'lambda' and peak(args.profile) > args.lambdas * args.threads:
+            print("Warning: load profile peak of {} is more than --lambdas x --threads".format(peak(args.profile)))
+
+    output_dir = make_output_dir(args.output)
+
+    seed(args.seed)
+
+    args.trace = None
+    if args.replay:
+        print("Reading trace")
+        offsets, workers, results = read_trace(args.replay)
+        args.trace = (offsets / args.speed, workers)
+        args.total = len(results)
+        print("\t{:,} requests over {:.1f} seconds".format(len(results), offsets[-1] / args.speed if len(results) else 0))
+    else:
+        # Generate the unique target channels
+        print("Generating URLs")
+        urls = gen_urls(args)
+        if len(urls) == 0:
+            sys.exit(1)
+        if args.unique:
+            if args.unique >= len(urls):
+                print("Only {} unique urls, not using --unique argument".format(len(urls)))
+            else:
+                urls = sample(urls, args.unique)
+        if len(urls) > args.total:
+            urls = sample(urls, args.total)
+
+        # Generate unique urls
+        if args.queue_depth:
+            results = gen_stream(args.total, urls, args.seed, args.distribution, args.reuse,
+                                 writes = args.writes, endpoints = args.endpoints, orientation = args.orientation,
+                                 tile_size = args.tile_size, hotspots = args.hotspots, zipf = args.zipf)
+            print("\t{:,} requests, generated as they are queued".format(args.total))
+        else:
+            results = gen_results(args.total, urls, args.seed, args.distribution, args.reuse,
+                                  writes = args.writes, endpoints = args.endpoints, orientation = args.orientation,
+                                  tile_size = args.tile_size, hotspots = args.hotspots, zipf = args.zipf)
+            print("\t{:,} requests for {:,} unique cutouts".format(len(results), results.unique()))
+        print("\tComplete")
+
+    BACKENDS[args.backend](args, results, output_dir)
 
+    if args.record_trace:
+        offsets, workers, urls = trace_from_records(sorted(glob.glob(os.path.join(output_dir, 'records-*.jsonl'))))
+        write_trace(args.record_trace, offsets, workers, urls)
+        print("Saved a trace of {:,} requests to {}".format(len(urls), args.record_trace))
@@ -0,0 +1,2 @@
+# autoscale_test.py is the command line script, not a module of tests
+collect_ignore = ['autoscale_test.py']
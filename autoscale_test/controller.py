@@ -0,0 +1,98 @@
+import math
+import time
+
+from stats import Timeline, window_stats
+
+class Controller(object):
+    """Additive increase, multiplicative decrease (AIMD) search for the highest sustainable concurrency
+
+    The run is split into steps of interval seconds. At the end of each step
+    its results are checked: if the p99 latency is at or below slo seconds
+    and the fraction of failed requests at or below max_error_rate the
+    concurrency is raised by increase, otherwise it is multiplied by
+    decrease. The first settle seconds of each step (by default a third of
+    it) are not judged, while the workers settle at the new concurrency.
+    Results arrive a while after they complete, so a step is only judged
+    delay seconds after it ends.
+
+    scale(concurrency) is called to apply each new concurrency, and returns
+    the concurrency actually applied (the lambda backend rounds it up to
+    whole lambdas). The concurrency is kept between minimum and maximum.
+    """
+
+    def __init__(self, scale, slo, max_error_rate=0.01, increase=1, decrease=0.5, interval=30,
+                 minimum=1, maximum=None, delay=2, settle=None):
+        self.scale = scale
+        self.slo = slo
+        self.max_error_rate = max_error_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.interval = interval
+        self.minimum = minimum
+        self.maximum = maximum
+        self.delay = delay
+        self.settle = interval / 3 if settle is None else settle
+        self.timeline = Timeline(1)
+        self.concurrency = None
+        self.started = None # Start of the current step
+        self.steps = [] # Results of each judged step
+
+    def start(self):
+        self.apply(max(self.increase, self.minimum))
+
+    def apply(self, concurrency):
+        if self.maximum:
+            concurrency = min(concurrency, self.maximum)
+        self.concurrency = self.scale(max(concurrency, self.minimum))
+        self.started = time.time()
+
+    def merge(self, timeline):
+        # Copied into new Stats, as the live console keeps the received ones
+        for start, stats in timeline.items():
+            self.timeline.windows.setdefault(int(start), window_stats()).merge(stats)
+
+    def update(self):
+        """Judge the current step once its results are in, returns True if a new step was started"""
+        if self.started is None or time.time() < self.started + self.interval + self.delay:
+            return False
+
+        first = int(math.ceil(self.started + self.settle))
+        stop = int(self.started + self.interval)
+        stats = window_stats()
+        for index in list(self.timeline.windows):
+            if index < stop:
+                if index >= first:
+                    stats.merge(self.timeline.windows[index])
+                del self.timeline.windows[index]
+
+        seconds = max(stop - first, 1)
+        rate = stats.count / seconds
+        p99 = stats.latency.percentile(99)
+        error_rate = sum(stats.errors.values()) / stats.count if stats.count else None
+        sustainable = (stats.count > 0 and p99 is not None and p99 <= self.slo
+                       and error_rate <= self.max_error_rate)
+        self.steps.append({
+            'start': self.started,
+            'concurrency': self.concurrency,
+            'in_flight': rate * (stats.latency.mean or 0), # Little's law
+            'count': stats.count,
+            'rate': rate,
+            'throughput': stats.bytes / seconds,
+            'p99': p99,
+            'error_rate': error_rate,
+            'sustainable': sustainable,
+        })
+
+        if stats.count == 0:
+            # Nothing finished yet (e.g. cold starts), hold the concurrency
+            self.apply(self.concurrency)
+        elif sustainable:
+            self.apply(self.concurrency + self.increase)
+        else:
+            self.apply(int(self.concurrency * self.decrease))
+        return True
+
+    def best(self):
+        """The step with the highest request rate that met the SLO, None if none did"""
+        steps = [step for step in self.steps if step['sustainable']]
+        return max(steps, key = lambda step: step['rate']) if steps else None
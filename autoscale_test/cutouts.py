@@ -1,30 +1,99 @@
-from random import randrange
+import os
+import json
+import time
+
+import numpy
+
+from multiprocessing.pool import ThreadPool
 
 from intern.remote.boss import BossRemote
 from intern.resource.boss.resource import *
 
-def rand_range(start, stop, min_size=None, max_size=None):
-    while True:
-        start_ = randrange(start, stop)
-        stop_ = randrange(start_+1, stop+1)
-        size = stop_ - start_
-        if min_size and min_size > size:
-            continue
-        if max_size and max_size < size:
-            continue
-        return '{}:{}'.format(start_, stop_)
+FRAME_ATTRS = ['x_start', 'x_stop', 'y_start', 'y_stop', 'z_start', 'z_stop']
+
+def size_range(start, stop, min_size=None, max_size=None):
+    """Smallest and largest valid cutout size within [start, stop)"""
+    extent = stop - start
+    low = min(max(min_size or 1, 1), extent)
+    high = max(min(max_size or extent, extent), low)
+    return low, high
+
+def load_catalog(filename, key, ttl):
+    try:
+        with open(filename, 'r') as fh:
+            entry = json.load(fh).get(key)
+    except (IOError, ValueError):
+        return None
+    if entry is None or time.time() - entry['time'] > ttl:
+        return None
+    return entry['channels']
+
+def save_catalog(filename, key, channels):
+    try:
+        with open(filename, 'r') as fh:
+            catalogs = json.load(fh)
+    except (IOError, ValueError):
+        catalogs = {}
+    catalogs[key] = {'time': time.time(), 'channels': channels}
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(filename, 'w') as fh:
+        json.dump(catalogs, fh)
+
+def discover(boss, args, threads=10):
+    """Find the target channels and the extents of their coordinate frames
+
+    Each level of the collection / experiment / channel hierarchy is queried
+    concurrently and each coordinate frame is only looked up once.
+    """
+    pool = ThreadPool(processes = threads)
+    try:
+        if args.collection is not None:
+            collections = [args.collection]
+        else:
+            collections = boss.list_collections()
+
+        def find_experiments(collection):
+            if args.experiment is not None:
+                return [(collection, args.experiment)]
+            return [(collection, experiment) for experiment in boss.list_experiments(collection)]
+        experiments = [e for es in pool.map(find_experiments, collections) for e in es]
 
-def gen_url(host, col, exp, chan, res, x, y, z, t=None):
-    x = rand_range(*x) if type(x) == tuple else x
-    y = rand_range(*y) if type(y) == tuple else y
-    z = rand_range(*z) if type(z) == tuple else z
+        def find_channels(item):
+            collection, experiment = item
+            if args.channel is not None:
+                channels = [args.channel]
+            else:
+                channels = boss.list_channels(collection, experiment)
+
+            exp = ExperimentResource(name = experiment,
+                                     collection_name = collection)
+            exp = boss.get_project(exp)
+            return [(collection, experiment, channel, exp.coord_frame) for channel in channels]
+        channels = [c for cs in pool.map(find_channels, experiments) for c in cs]
+
+        def get_frame(name):
+            coord = boss.get_project(CoordinateFrameResource(name = name))
+            return {attr: getattr(coord, attr) for attr in FRAME_ATTRS}
+        names = sorted(set(c[3] for c in channels))
+        frames = dict(zip(names, pool.map(get_frame, names)))
 
-    fmt = 'https://{}/v0.7/cutout/{}/{}/{}/{}/{}/{}/{}/'
-    url = fmt.format(host, col, exp, chan, res, x, y, z)
-    if t:
-        t = rand_range(*t) if type(t) == tuple else t
-        url += '{}/'.format(t)
-    return url
+        def get_channel(item):
+            collection, experiment, channel, coord_frame = item
+            ch = ChannelResource(name = channel,
+                                 experiment_name = experiment,
+                                 collection_name = collection)
+            ch = boss.get_project(ch)
+            return {'collection': collection,
+                    'experiment': experiment,
+                    'channel': channel,
+                    'datatype': ch.datatype,
+                    'frame': frames[coord_frame]}
+        return pool.map(get_channel, channels)
+    finally:
+        pool.terminate()
 
 def gen_urls(args):
     config = {'protocol': 'https',
@@ -35,81 +104,348 @@ def gen_urls(args):
     results = []
 
     try:
-        if args.collection is not None:
-            collections = [args.collection]
-        else:
-            collections = boss.list_collections()
+        key = '/'.join([args.hostname, args.collection or '*', args.experiment or '*', args.channel or '*'])
+        channels = None
+        if args.cache and args.cache_ttl > 0:
+            channels = load_catalog(args.cache, key, args.cache_ttl)
+            if channels is not None:
+                print("\tUsing cached channel catalog from {}".format(args.cache))
+        if channels is None:
+            channels = discover(boss, args, args.discovery_threads)
+            if args.cache and args.cache_ttl > 0:
+                save_catalog(args.cache, key, channels)
 
-        for collection in collections:
-            if args.experiment is not None:
-                experiments = [args.experiment]
+        for entry in channels:
+            collection = entry['collection']
+            experiment = entry['experiment']
+            channel = entry['channel']
+            coord = entry['frame']
+
+            def check_range(name, var, start, stop):
+                start_, stop_ = map(int, var.split(':'))
+                if start_ < start:
+                    fmt = "{} range start for {}/{}/{} is less than the coordinate frame, setting to minimum"
+                    print(fmt.format(name, collection, experiment, channel))
+                    start_ = start
+                if stop_ > stop:
+                    fmt = "{} range stop for {}/{}/{} is greater than the coordinate frame, setting to maximum"
+                    print(fmt.format(name, collection, experiment, channel))
+                    stop_ = stop
+                return '{}:{}'.format(start_, stop_)
+
+            if args.x_range:
+                x = check_range('X', args.x_range, coord['x_start'], coord['x_stop'])
             else:
-                experiments = boss.list_experiments(collection)
-
-            for experiment in experiments:
-                if args.channel is not None:
-                    channels = [args.channel]
-                else:
-                    channels = boss.list_channels(collection, experiment)
-
-                exp = ExperimentResource(name = experiment,
-                                         collection_name = collection)
-                exp = boss.get_project(exp)
-
-                coord = CoordinateFrameResource(name = exp.coord_frame)
-                coord = boss.get_project(coord)
-
-                for channel in channels:
-                    ch = ChannelResource(name = channel,
-                                         experiment_name = experiment,
-                                         collection_name = collection)
-                    ch = boss.get_project(ch)
-
-                    def check_range(name, var, start, stop):
-                        start_, stop_ = map(int, var.split(':'))
-                        if start_ < start:
-                            fmt = "{} range start for {}/{}/{} is less than the coordinate frame, setting to minimum"
-                            print(fmt.format(name, collection, experiment, channel))
-                            start_ = start
-                        if stop_ > stop:
-                            fmt = "{} range stop for {}/{}/{} is greater than the coordinate frame, setting to maximum"
-                            print(fmt.format(name, collection, experiment, channel))
-                            stop_ = stop
-                        return '{}:{}'.format(start_, stop_)
-
-                    if args.x_range:
-                        x = check_range('X', args.x_range, coord.x_start, coord.x_stop)
-                    else:
-                        x = (coord.x_start, coord.x_stop, args.min, args.max)
-
-                    if args.y_range:
-                        y = check_range('Y', args.y_range, coord.y_start, coord.y_stop)
-                    else:
-                        y = (coord.y_start, coord.y_stop, args.min, args.max)
-
-                    if args.z_range:
-                        z = check_range('Z', args.z_range, coord.z_start, coord.z_stop)
-                    else:
-                        z = (coord.z_start, coord.z_stop, args.min, args.max)
-
-                    # Arguments to gen_url
-                    results.append((args.hostname,
-                                    collection,
-                                    experiment,
-                                    channel,
-                                    0, x, y, z, None))
+                x = (coord['x_start'], coord['x_stop'], args.min, args.max)
+
+            if args.y_range:
+                y = check_range('Y', args.y_range, coord['y_start'], coord['y_stop'])
+            else:
+                y = (coord['y_start'], coord['y_stop'], args.min, args.max)
+
+            if args.z_range:
+                z = check_range('Z', args.z_range, coord['z_start'], coord['z_stop'])
+            else:
+                z = (coord['z_start'], coord['z_stop'], args.min, args.max)
+
+            # host, collection, experiment, channel, resolution, x, y, z, t, datatype
+            results.append((args.hostname,
+                            collection,
+                            experiment,
+                            channel,
+                            0, x, y, z, None,
+                            entry.get('datatype', 'uint8')))
     except Exception as e:
         print("Error generating URLs: {}".format(e))
 
     return results
 
-def gen_results(total, seq):
-    results = []
-    d, m = divmod(total, len(seq))
-    for i in range(d):
-        for s in seq:
-            results.append(gen_url(*s))
-    for s in seq[:m]:
-        results.append(gen_url(*s))
+AXES = ['x', 'y', 'z', 't']
+ENDPOINTS = ['cutout', 'tile', 'image']
+ORIENTATIONS = ['xy', 'xz', 'yz']
+CUBOID_SIZE = {'x': 512, 'y': 512, 'z': 16, 't': 1} # Boss storage and cache cuboid
+
+class Workload(object):
+    """Sequence of request URLs, stored as arrays and formatted when accessed
+
+    Request i targets channel i % len(seq), where each entry of seq is a
+    channel and its ranges as returned by gen_urls. Each request is a cutout, or a tile or image of
+    the same region (see ENDPOINTS). Writes are formatted as
+    'POST <datatype> <URL>'. Slicing returns a Workload sharing the same arrays.
+    """
+
+    def __init__(self, seq, channels, ranges, writes=None, endpoints=None, orientation='xy', tile_size=512):
+        self.seq = seq
+        self.channels = channels # index into seq for each request
+        self.ranges = ranges # axis -> (starts, stops) arrays, None if the axis is not used
+        self.writes = writes # whether each request is a write, None if there are none
+        self.endpoints = endpoints # index into ENDPOINTS for each request, None if all are cutouts
+        self.orientation = orientation # plane of the tile and image requests
+        self.tile_size = tile_size
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            ranges = {axis: None if r is None else (r[0][key], r[1][key])
+                      for axis, r in self.ranges.items()}
+            writes = None if self.writes is None else self.writes[key]
+            endpoints = None if self.endpoints is None else self.endpoints[key]
+            return Workload(self.seq, self.channels[key], ranges, writes, endpoints,
+                            self.orientation, self.tile_size)
+
+        endpoint = 'cutout' if self.endpoints is None else ENDPOINTS[self.endpoints[key]]
+        host, col, exp, chan, res = self.seq[self.channels[key]][:5]
+        url = 'https://{}/v0.7/{}/{}/{}/{}/'.format(host, endpoint, col, exp, chan)
+        if endpoint == 'tile':
+            url += '{}/{}/{}/'.format(self.orientation, self.tile_size, res)
+        elif endpoint == 'image':
+            url += '{}/{}/'.format(self.orientation, res)
+        else:
+            url += '{}/'.format(res)
+
+        for axis in AXES:
+            if self.ranges[axis] is None:
+                continue
+            start, stop = self.ranges[axis][0][key], self.ranges[axis][1][key]
+            if stop <= start:
+                continue
+            if endpoint == 'cutout' or (endpoint == 'image' and axis in self.orientation):
+                url += '{}:{}/'.format(start, stop)
+            elif endpoint == 'tile' and axis in self.orientation:
+                url += '{}/'.format(start // self.tile_size) # Tile index
+            else:
+                url += '{}/'.format(start) # Slice of the tile or image
+        if self.writes is not None and self.writes[key]:
+            return 'POST {} {}'.format(self.seq[self.channels[key]][9], url)
+        return url
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def unique(self):
+        """Number of distinct cutouts"""
+        columns = [self.channels]
+        if self.endpoints is not None:
+            columns.append(self.endpoints)
+        for axis in AXES:
+            if self.ranges[axis] is not None:
+                columns.extend(self.ranges[axis])
+        return len(numpy.unique(numpy.stack(columns, axis=1), axis=0))
+
+def axis_bounds(seq, index):
+    """Arrays of (range start, range stop, min size, max size) for one axis of every seq entry"""
+    bounds = []
+    for s in seq:
+        value = s[index] if index < len(s) else None
+        if value is None:
+            bounds.append((0, 0, 0, 0))
+        elif type(value) == tuple:
+            bounds.append((value[0], value[1]) + size_range(*value))
+        else:
+            # Fixed range, only one valid size and start
+            start, stop = map(int, value.split(':'))
+            bounds.append((start, stop, stop - start, stop - start))
+    return numpy.array(bounds, dtype=numpy.int64).T
+
+def grid(bounds, align):
+    """First grid line, number of whole grid cells and whether to align, for each range"""
+    starts, stops, min_sizes, max_sizes = bounds
+    first = -(-starts // align) * align
+    cells = (stops - first) // align
+    # Fixed ranges and ranges without a whole grid cell are left as they are
+    aligned = (align > 1) & (cells >= 1) & (min_sizes != stops - starts)
+    return first, cells, aligned
+
+def sample_axis(rng, channels, bounds, align=1, batch=1000000):
+    """Random (starts, stops) arrays for each request, optionally snapped to a grid of width align
+
+    Aligned sizes are rounded to the nearest whole number of grid cells.
+    """
+    starts, stops, min_sizes, max_sizes = bounds
+    first, cells, aligned = grid(bounds, align)
+
+    total = len(channels)
+    start = numpy.empty(total, dtype=numpy.int64)
+    stop = numpy.empty(total, dtype=numpy.int64)
+    for i in range(0, total, batch):
+        c = channels[i:i+batch]
+        size = rng.integers(min_sizes[c], max_sizes[c], endpoint=True)
+        offset = rng.integers(starts[c], stops[c] - size, endpoint=True)
+
+        a = aligned[c]
+        if a.any():
+            cells_ = numpy.maximum(cells[c], 1)
+            count = numpy.clip(numpy.rint(size / align).astype(numpy.int64), 1, cells_)
+            cell = rng.integers(0, cells_ - count, endpoint=True)
+            size = numpy.where(a, count * align, size)
+            offset = numpy.where(a, first[c] + cell * align, offset)
+
+        start[i:i+batch] = offset
+        stop[i:i+batch] = offset + size
+    return (start, stop)
+
+def uniform(rng, layout, index, channels, bounds, options):
+    return {axis: sample_axis(rng, channels, bounds[axis]) for axis in bounds}
+
+def aligned(rng, layout, index, channels, bounds, options):
+    return {axis: sample_axis(rng, channels, bounds[axis], CUBOID_SIZE[axis]) for axis in bounds}
+
+def hotspot(rng, layout, index, channels, bounds, options):
+    # Each channel gets a set of cuboid aligned hot regions, and requests
+    # pick between them with Zipf distributed popularity
+    count = options.get('hotspots', 10)
+    regions = numpy.repeat(numpy.arange(len(bounds['x'][0])), count)
+    boxes = {axis: sample_axis(layout, regions, bounds[axis], CUBOID_SIZE[axis]) for axis in bounds}
+
+    weights = 1 / numpy.arange(1, count + 1) ** options.get('zipf', 1.1)
+    rank = rng.choice(count, size=len(channels), p=weights / weights.sum())
+    index = channels * count + rank
+    return {axis: (start[index], stop[index]) for axis, (start, stop) in boxes.items()}
+
+def raster(rng, layout, index, channels, bounds, options):
+    # Each channel gets one cuboid aligned box size, and its requests sweep
+    # the frame with it in raster order (x fastest), wrapping around at the end
+    count = len(bounds['x'][0])
+    boxes = {axis: sample_axis(layout, numpy.arange(count), bounds[axis], CUBOID_SIZE[axis]) for axis in bounds}
+
+    sweep = index // count
+    stride = numpy.ones(count, dtype=numpy.int64)
+    tiles = {}
+    for axis in AXES:
+        if axis not in bounds:
+            continue
+        starts, stops = bounds[axis][:2]
+        first, cells, aligned_ = grid(bounds[axis], CUBOID_SIZE[axis])
+        origin = numpy.where(aligned_, first, starts)
+        size = boxes[axis][1] - boxes[axis][0]
+        positions = numpy.maximum((stops - origin) // numpy.maximum(size, 1), 1)
+        tiles[axis] = (origin, size, positions, stride.copy())
+        stride *= positions
+
+    results = {}
+    for axis, (origin, size, positions, stride_) in tiles.items():
+        c = channels
+        position = (sweep % stride[c]) // stride_[c] % positions[c]
+        start = origin[c] + position * size[c]
+        results[axis] = (start, start + size[c])
+    return results
+
+DISTRIBUTIONS = {
+    'uniform': uniform,
+    'aligned': aligned,
+    'hotspot': hotspot,
+    'raster': raster,
+}
+
+def repeat_requests(rng, channels, count, ranges, reuse):
+    """Make a reuse fraction of the requests repeat an earlier request for the same channel"""
+    total = len(channels)
+    index = numpy.arange(total)
+    repeat = rng.random(total) < reuse
+    repeat[:count] = False # The first request for each channel has nothing to repeat
+
+    earlier = index // count # Number of earlier requests for the same channel
+    back = rng.integers(1, numpy.maximum(earlier, 1), endpoint=True)
+    source = numpy.where(repeat, index - back * count, index)
+    # Follow repeats of repeats back to the request they all copy
+    while True:
+        source_ = source[source]
+        if (source_ == source).all():
+            break
+        source = source_
+
+    return {axis: (start[source], stop[source]) for axis, (start, stop) in ranges.items()}
+
+def size_classes(ranges, writes):
+    """Round the size of the write cutouts down to a power of two on each axis
+
+    Each distinct data size needs its own payload, this keeps them few.
+    """
+    results = {}
+    for axis, (start, stop) in ranges.items():
+        size = stop - start
+        rounded = numpy.where(size > 0, 1 << numpy.log2(numpy.maximum(size, 1)).astype(numpy.int64), size)
+        results[axis] = (start, numpy.where(writes, start + rounded, stop))
     return results
 
+def parse_endpoints(spec):
+    """Weights of each endpoint in the request mix, from a spec like 'cutout:1,tile:3,image:1'"""
+    weights = {}
+    for item in spec.split(','):
+        name, _, weight = item.strip().partition(':')
+        if name not in ENDPOINTS:
+            raise ValueError("Unknown endpoint '{}', expected one of {}".format(name, ', '.join(ENDPOINTS)))
+        weights[name] = float(weight or 1)
+    if sum(weights.values()) <= 0:
+        raise ValueError("Endpoint weights have to add up to more than zero")
+    return weights
+
+def cutout_share(endpoints):
+    """Fraction of the requests that are cutouts, the most that can be written"""
+    if not endpoints:
+        return 1.0
+    return endpoints.get('cutout', 0) / sum(endpoints.values())
+
+def gen_results(total, seq, seed=None, distribution='uniform', reuse=0.0, first=0, writes=0.0,
+                endpoints=None, orientation='xy', tile_size=512, **options):
+    """Generate total requests with the given spatial distribution, a writes fraction of them POSTs
+
+    endpoints are the weights of the cutout, tile and image requests (see
+    parse_endpoints()). Only cutouts are written, so writes can be at most
+    cutout_share(endpoints). Tiles and images are of the generated regions,
+    in the orientation plane.
+
+    Sizes and offsets are sampled directly from their valid ranges in NumPy
+    batches. options are passed on to the distribution (hotspots, zipf).
+    first is the index of the first request, so a workload can be generated
+    in blocks that continue each other (see gen_stream()), if every block is
+    given the same seed. Repeated requests (reuse) only repeat requests of
+    the same block.
+    """
+    if seed is None:
+        seed = numpy.random.SeedSequence().entropy
+    # The hot regions and raster boxes come from their own generator, so
+    # they are the same in every block
+    layout = numpy.random.default_rng(numpy.random.SeedSequence(seed, spawn_key=(0,)))
+    rng = numpy.random.default_rng(numpy.random.SeedSequence(seed, spawn_key=(1, first)))
+    index = numpy.arange(first, first + total)
+    channels = index % len(seq)
+
+    bounds = {}
+    for axis, i in zip(AXES, range(5, 9)):
+        bounds_ = axis_bounds(seq, i)
+        if bounds_[1].any():
+            bounds[axis] = bounds_
+
+    ranges = DISTRIBUTIONS[distribution](rng, layout, index, channels, bounds, options)
+    if reuse > 0:
+        ranges = repeat_requests(rng, channels, len(seq), ranges, reuse)
+    endpoint = None
+    if endpoints and set(endpoints) != {'cutout'}:
+        weights = numpy.array([endpoints.get(name, 0) for name in ENDPOINTS], dtype=numpy.float64)
+        endpoint = rng.choice(len(ENDPOINTS), size=total, p=weights / weights.sum())
+    write = None
+    if writes > 0:
+        # Writes are picked among the cutouts, so they are a writes fraction of all the requests
+        write = rng.random(total) < writes / cutout_share(endpoints)
+        if endpoint is not None:
+            write &= endpoint == ENDPOINTS.index('cutout')
+        ranges = size_classes(ranges, write)
+    for axis in AXES:
+        ranges.setdefault(axis, None)
+
+    return Workload(seq, channels, ranges, write, endpoint, orientation, tile_size)
+
+def gen_stream(total, seq, seed=None, distribution='uniform', reuse=0.0, block=100000, **options):
+    """Generate the same kind of cutouts as gen_results(), block requests at a time
+
+    Yields the URLs one at a time, so memory use does not grow with total.
+    """
+    if seed is None:
+        seed = numpy.random.SeedSequence().entropy
+    for first in range(0, total, block):
+        yield from gen_results(min(block, total - first), seq, seed, distribution, reuse,
+                               first, **options)
@@ -1,63 +1,552 @@
+import ssl
 import json
+import zlib
+import base64
 import boto3
-from time import time as now
+import random
+import socket
+import struct
+import threading
+from time import time as now, sleep
+from botocore.client import Config
 
-from urllib2 import Request, urlopen, HTTPError
-from urllib import urlencode
+from stats import Stats, Timeline, endpoint
+from profiles import concurrency
 
-def request(queue, url, headers = {}):
-    msg = {'start': now()}
+try:
+    from Queue import Queue, Empty
+except ImportError: # Python 3
+    from queue import Queue, Empty
+
+try:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlsplit
+except ImportError: # Python 3, when run by the local backend
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlsplit
+
+try:
+    import blosc
+except ImportError: # Not packaged with the lambda, responses are not decoded
+    blosc = None
+
+SQS_BATCH_SIZE = 10 # Maximum number of entries in a single SQS batch request
+DELETE_INTERVAL = 5 # seconds, longest a finished message waits to be deleted
+TIMEOUT_MARGIN = 30 * 1000 # milliseconds, stop receiving when the lambda has less time left
+RESULT_BATCH_BYTES = 128 * 1024 # uncompressed size of the records sent in one result message
+RESULT_INTERVAL = 2 # seconds, longest a finished record waits to be sent
+SUMMARY_INTERVAL = 10 # seconds, how often summaries are sent
+PAYLOAD_CACHE_BYTES = 32 * 1024 * 1024 # largest total size of the cached write payloads
+PREFETCH_SECONDS = 10 # open loop, how far ahead of their send time messages are received (with the
+                      # result and delete intervals, well under the 30 second visibility timeout)
+
+DTYPE_SIZES = {'uint8': 1, 'uint16': 2, 'uint32': 4, 'uint64': 8, 'float32': 4, 'float64': 8}
+BLOSC_HEADER = struct.Struct('<BBBBIII') # version, compressor version, flags, typesize, nbytes, blocksize, cbytes
+BLOSC_MEMCPYED = 0x2 # the data follows the header uncompressed
+
+# Identifies the execution environment, which Lambda keeps between warm
+# invocations. The first invocation in it is a cold start.
+CONTAINER = '{:016x}'.format(random.getrandbits(64))
+cold = True
+
+def worker_identity(worker, invocation = None, launched = None):
+    """Fields added to every record of a worker invocation, to attribute it to the worker"""
+    global cold
+    identity = {
+        'worker': worker,
+        'invocation': invocation or '{:016x}'.format(random.getrandbits(64)),
+        'container': CONTAINER,
+        'cold': cold,
+        'invoked': now(),
+        'launched': launched,
+    }
+    cold = False
+    return identity
+
+def request_headers(token):
+    return {
+        'Authorization': 'Token {}'.format(token),
+        'Accept': 'application/blosc',
+    }
+
+def parse_target(target):
+    """(method, URL, datatype) of a request, given as a URL to read or 'POST <datatype> <URL>' to write"""
+    if target.startswith('POST '):
+        method, datatype, url = target.split(' ', 2)
+        return method, url, datatype
+    return 'GET', target, None
+
+def cutout_bytes(url, datatype):
+    """Size of the data in a cutout URL"""
+    size = DTYPE_SIZES[datatype]
+    for part in urlsplit(url).path.split('/'):
+        if ':' in part:
+            start, stop = part.split(':')
+            size *= int(stop) - int(start)
+    return size
+
+# Write payloads, made once for each size class and reused, by (size, typesize)
+payloads = {}
+payloads_lock = threading.Lock()
+pattern = bytes(bytearray(random.randrange(64) for i in range(64 * 1024)))
+
+def make_payload(nbytes, typesize):
+    """Blosc encoded cuboid of nbytes of data"""
+    key = (nbytes, typesize)
+    with payloads_lock:
+        if key in payloads:
+            return payloads[key]
+
+    data = (pattern * (nbytes // len(pattern) + 1))[:nbytes]
+    if blosc is not None:
+        payload = blosc.compress(data, typesize = typesize)
+    else:
+        # Without the blosc package (in the lambda) the data is sent as an
+        # uncompressed blosc frame, which any blosc decompressor accepts
+        header = BLOSC_HEADER.pack(2, 1, BLOSC_MEMCPYED, typesize, nbytes,
+                                   min(nbytes, 256 * 1024), nbytes + BLOSC_HEADER.size)
+        payload = header + data
+
+    with payloads_lock:
+        if sum(len(p) for p in payloads.values()) + len(payload) <= PAYLOAD_CACHE_BYTES:
+            payloads[key] = payload
+    return payload
+
+# Idle keep-alive connections, by (scheme, host). This lives at module level
+# so connections are reused by every thread and by later (warm) invocations
+# of the handler
+connections = {}
+connections_lock = threading.Lock()
+ssl_context = ssl.create_default_context()
+
+def open_connection(parts, msg):
+    """Open a new connection, timing the DNS lookup, TCP connect and TLS handshake
+
+    Like socket.create_connection(), every resolved address is tried in
+    turn (e.g. an IPv6 address without IPv6 egress, then IPv4). The connect
+    time is of the attempt that succeeded.
+    """
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    msg['dns_start'] = now()
+    addresses = socket.getaddrinfo(parts.hostname, port, 0, socket.SOCK_STREAM)
+    msg['dns_stop'] = now()
+
+    error = socket.error("getaddrinfo returned no addresses")
+    for family, kind, proto, _, address in addresses:
+        sock = socket.socket(family, kind, proto)
+        try:
+            msg['connect_start'] = now()
+            sock.connect(address)
+            msg['connect_stop'] = now()
+            break
+        except Exception as e:
+            sock.close()
+            error = e
+    else:
+        raise error
 
     try:
-        req = Request(url,
-                      headers = headers)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        if parts.scheme == 'https':
+            msg['tls_start'] = now()
+            sock = ssl_context.wrap_socket(sock, server_hostname = parts.hostname)
+            msg['tls_stop'] = now()
+    except Exception:
+        sock.close()
+        raise
+
+    # The connection uses the already open socket instead of connecting itself
+    cls = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+    conn = cls(parts.netloc)
+    conn.sock = sock
+    return conn
+
+def get_connection(parts, msg):
+    with connections_lock:
+        idle = connections.get((parts.scheme, parts.netloc))
+        if idle:
+            msg['reused'] = True
+            return idle.pop()
+
+    msg['reused'] = False
+    return open_connection(parts, msg)
 
-        msg['req_start'] = now()
-        resp = urlopen(req)
-        msg['read_start'] = msg['req_stop'] = now()
-        msg['code'] = resp.getcode()
+def release_connection(scheme, host, conn):
+    with connections_lock:
+        connections.setdefault((scheme, host), []).append(conn)
+
+def request(target, headers = {}, identity = None, intended = None, decode = False):
+    method, url, datatype = parse_target(target)
+    body = None
+    if endpoint(url) in ('tile', 'image'):
+        headers = dict(headers)
+        headers['Accept'] = 'image/png'
+    if method == 'POST':
+        body = make_payload(cutout_bytes(url, datatype), DTYPE_SIZES[datatype])
+        headers = dict(headers)
+        headers['Content-Type'] = 'application/blosc'
+
+    # In open loop mode the request is sent at its scheduled time, if it is
+    # late the delay is recorded so the latency can be measured from when
+    # the request should have been sent
+    if intended is not None:
+        delay = intended - now()
+        if delay > 0:
+            sleep(delay)
+
+    msg = {'start': now(), 'url': url}
+    msg.update(identity or {})
+    if intended is not None:
+        msg['intended'] = intended
+    if method == 'POST':
+        msg['method'] = method
+        msg['datatype'] = datatype
+        msg['sent'] = len(body)
+
+    try:
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        # The server may have closed an idle connection, so a request on a
+        # reused connection that fails is retried once on a new connection
+        while True:
+            conn = get_connection(parts, msg)
+            try:
+                msg['req_start'] = now()
+                conn.request(method, path, body = body, headers = headers)
+                resp = conn.getresponse()
+                break
+            except Exception:
+                conn.close()
+                if not msg['reused']:
+                    raise
+
+        headers_stop = now()
+        msg['code'] = resp.status
         data = resp.read()
-        msg['bytes'] = len(data)
-        msg['read_stop'] = now()
-    except HTTPError as e:
-        msg['error_start'] = now()
-        msg['code'] = e.code
-        msg['error'] = str(e)
-        msg['error_stop'] = now()
+        if resp.will_close:
+            conn.close()
+        else:
+            release_connection(parts.scheme, parts.netloc, conn)
+
+        if resp.status >= 400:
+            msg['error_start'] = headers_stop
+            msg['error'] = 'HTTP Error {}: {}'.format(resp.status, resp.reason)
+            msg['error_stop'] = now()
+        else:
+            msg['read_start'] = msg['req_stop'] = headers_stop
+            msg['bytes'] = len(data)
+            msg['read_stop'] = now()
+
+            # Client side decompression of the cutout, timed separately from the request
+            if decode and blosc is not None and resp.getheader('Content-Type', '').startswith('application/blosc'):
+                msg['decode_start'] = now()
+                blosc.decompress(data)
+                msg['decode_stop'] = now()
     except Exception as e:
         msg['error'] = str(e)
 
     msg['stop'] = now()
+    return msg
 
+def send_result(sqs, queue, msg):
     try:
-        queue.send_message(MessageBody = json.dumps(msg))
+        sqs.send_message(QueueUrl = queue, MessageBody = json.dumps(msg))
     except Exception as e:
         print("{}: {}".format(e, msg))
 
+def compress(data):
+    return base64.b64encode(zlib.compress(data.encode('utf-8'))).decode('ascii')
 
-def handler(event, context):
-    token = event['token']
-    #urls = event['urls']
+def decompress(data):
+    return zlib.decompress(base64.b64decode(data)).decode('utf-8')
 
-    sqs = boto3.resource('sqs')
-    queue = sqs.Queue(event['queue'])
-    input_queue = sqs.Queue(event['input'])
+def pack_records(records):
+    """Compress a list of JSON encoded records into one result message"""
+    return {'records': compress('[' + ','.join(records) + ']')}
 
-    headers = {
-        'Authorization': 'Token {}'.format(token),
-        'Accept': 'application/blosc',
-    }
+def unpack_result(body):
+    """(list of records, summary Timeline or None, summary Stats or None) held by a result message
+
+    A message is either a batch of records, a single record or a summary.
+    """
+    msg = json.loads(body)
+    if 'summary' in msg:
+        summary = json.loads(decompress(msg['summary']))
+        return [], Timeline.from_state(summary['timeline']), Stats.from_state(summary['stats'])
+    if 'records' in msg:
+        return json.loads(decompress(msg['records'])), None, None
+    return [msg], None, None
+
+class ResultBatch(object):
+    """Records buffered by the download threads and sent as one compressed message
+
+    A batch is sent once it holds RESULT_BATCH_BYTES of records, or by
+    flush() once its oldest record has waited RESULT_INTERVAL seconds. The
+    input messages of the records are only passed on to be deleted after
+    their results have been sent.
+    """
+
+    def __init__(self, sqs, queue, done):
+        self.sqs = sqs
+        self.queue = queue
+        self.done = done
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.records = []
+        self.receipts = []
+        self.size = 0
+        self.started = None
+
+    def add(self, msg, receipt):
+        record = json.dumps(msg)
+        with self.lock:
+            if self.started is None:
+                self.started = now()
+            self.records.append(record)
+            self.receipts.append(receipt)
+            self.size += len(record)
+            full = self.size >= RESULT_BATCH_BYTES
+        if full:
+            self.flush(force = True)
+
+    def flush(self, force = False):
+        with self.lock:
+            if self.started is None or (not force and now() - self.started < RESULT_INTERVAL):
+                return
+            records, receipts = self.records, self.receipts
+            self.reset()
+        send_result(self.sqs, self.queue, pack_records(records))
+        for receipt in receipts:
+            self.done.put(receipt)
+
+class ResultSummary(ResultBatch):
+    """Per window summaries of the records, sent every SUMMARY_INTERVAL seconds
+
+    Instead of the records, the worker sends the mergeable Stats of all of
+    them and the counts and latencies of each window of its timeline, so
+    the size of the result messages does not grow with the request rate.
+    """
+
+    def __init__(self, sqs, queue, done, window = 10):
+        self.window = window
+        super(ResultSummary, self).__init__(sqs, queue, done)
+
+    def reset(self):
+        self.stats = Stats()
+        self.timeline = Timeline(self.window)
+        self.receipts = []
+        self.started = None
+
+    def add(self, msg, receipt):
+        with self.lock:
+            if self.started is None:
+                self.started = now()
+            self.stats.add(msg)
+            self.timeline.add(msg)
+            self.receipts.append(receipt)
+
+    def flush(self, force = False):
+        with self.lock:
+            if self.started is None or (not force and now() - self.started < SUMMARY_INTERVAL):
+                return
+            summary = {'timeline': self.timeline.to_state(), 'stats': self.stats.to_state()}
+            receipts = self.receipts
+            self.reset()
+        send_result(self.sqs, self.queue, {'summary': compress(json.dumps(summary))})
+        for receipt in receipts:
+            self.done.put(receipt)
+
+def drain(work, receiver = None):
+    """Take the messages waiting in the work queue, until the receiver thread has finished"""
+    receipts = []
+    while (receiver is not None and receiver.is_alive()) or not work.empty():
+        try:
+            item = work.get(timeout = 1)
+        except Empty:
+            continue
+        if item is not None:
+            receipts.append(item[0]['ReceiptHandle'])
+    return receipts
+
+def release_messages(sqs, queue, receipts):
+    # Make the messages held by a worker that is not going to request them
+    # visible again right away, instead of after the visibility timeout
+    for i in range(0, len(receipts), SQS_BATCH_SIZE):
+        entries = [{'Id': str(j), 'ReceiptHandle': receipt, 'VisibilityTimeout': 0}
+                   for j, receipt in enumerate(receipts[i:i + SQS_BATCH_SIZE])]
+        try:
+            sqs.change_message_visibility_batch(QueueUrl = queue, Entries = entries)
+        except Exception as e:
+            print("Could not release {} messages: {}".format(len(entries), e))
+
+def delete_messages(sqs, queue, receipts):
+    entries = [{'Id': str(i), 'ReceiptHandle': receipt} for i, receipt in enumerate(receipts)]
+    try:
+        sqs.delete_message_batch(QueueUrl = queue, Entries = entries)
+    except Exception as e:
+        print("Could not delete {} messages: {}".format(len(entries), e))
 
-    #for url in urls:
-    #    request(queue, url,
-    #            headers = headers)
-    retry = 2
+def receive(sqs, queue, work, threads, context, rate = None, start = None, retry = 2, stop = None,
+            profile = None, slots = (), until = None, begin = None):
+    # The work queue is bounded, so this blocks once the next batch has been
+    # prefetched and only receives more as the download threads catch up.
+    # In open loop mode the schedule starts at begin, by default right away.
+    received = now() if begin is None else begin
+    scheduled = 0
     while retry > 0:
-        msgs = input_queue.receive_messages(WaitTimeSeconds=20, MaxNumberOfMessages=1)
+        if context is not None and context.get_remaining_time_in_millis() < TIMEOUT_MARGIN:
+            break
+        if stop is not None and now() >= stop:
+            break
+
+        # Received messages are hidden from the other workers only for the
+        # visibility timeout, so with a load profile only hold a couple of
+        # messages for each active slot, and none while every slot is idle.
+        # In open loop mode only receive the messages due in the next
+        # PREFETCH_SECONDS.
+        count = SQS_BATCH_SIZE
+        if profile:
+            target = concurrency(profile, now() - start)
+            if target is None:
+                break
+            active = len([slot for slot in slots if slot < target])
+            if active == 0 and not work.empty():
+                release_messages(sqs, queue, drain(work))
+            count = min(2 * active - work.qsize(), SQS_BATCH_SIZE)
+        elif rate:
+            due = now() + PREFETCH_SECONDS - (received + scheduled / rate)
+            count = min(int(due * rate) + 1, SQS_BATCH_SIZE) if due >= 0 else 0
+        if count <= 0:
+            sleep(0.1)
+            continue
+
+        resp = sqs.receive_message(QueueUrl = queue,
+                                   WaitTimeSeconds = 20 if stop is None else int(min(max(stop - now(), 0), 20)),
+                                   MaxNumberOfMessages = count)
+        msgs = resp.get('Messages', [])
         if len(msgs) == 0:
-            retry -= 1
+            # A replayed trace is queued as its requests come due, so the
+            # queue can be empty for a while before until
+            if until is None or now() >= until:
+                retry -= 1
             continue
-        msg = msgs[0]
-        request(queue, msg.body, headers = headers)
-        input_queue.delete_messages(Entries=[{'Id':'X', 'ReceiptHandle': msg.receipt_handle}])
+        for msg in msgs:
+            intended = None
+            if msg['Body'].startswith('{'):
+                # Replayed trace, the message holds the URL and when to send it
+                item = json.loads(msg['Body'])
+                msg['Body'] = item['url']
+                intended = start + item['offset']
+            elif rate:
+                intended = received + scheduled / rate
+                scheduled += 1
+            work.put((msg, intended))
+
+    for i in range(threads):
+        work.put(None)
+
+def download(batch, headers, identity, work, done, slot = 0, profile = None, start = None,
+             decode = False, stop = None):
+    while True:
+        # Workers launched by the adaptive controller only run until stop
+        if stop is not None and now() >= stop:
+            done.put(None)
+            break
+
+        # With a load profile this thread only works while the profile's
+        # concurrency is above its slot number
+        if profile:
+            target = concurrency(profile, now() - start)
+            if target is None:
+                done.put(None)
+                break
+            if slot >= target:
+                sleep(0.1)
+                continue
+
+        item = work.get()
+        if item is None:
+            done.put(None)
+            break
+        msg, intended = item
+        batch.add(request(msg['Body'], headers = headers, identity = identity,
+                          intended = intended, decode = decode),
+                  msg['ReceiptHandle'])
+
+def handler(event, context):
+    token = event['token']
+    threads = event.get('threads', 1)
+    rate = event.get('rate') # requests/sec made by this worker, None for closed loop
+
+    # Clients are thread safe, so one is shared by the receive and download threads
+    sqs = boto3.client('sqs', config = Config(max_pool_connections = threads + 2))
+
+    headers = request_headers(token)
+    identity = worker_identity(event.get('worker'), context.aws_request_id if context is not None else None,
+                               event.get('launched'))
+
+    work = Queue(maxsize = threads + SQS_BATCH_SIZE)
+    done = Queue()
+    if event.get('summaries'):
+        batch = ResultSummary(sqs, event['queue'], done, event.get('window', 10))
+    else:
+        batch = ResultBatch(sqs, event['queue'], done)
+
+    # A relaunched worker's schedule continues once the requests the last
+    # worker prefetched before it stopped receiving have been sent
+    begin = now() + PREFETCH_SECONDS if event.get('relaunched') else None
+
+    workers = [threading.Thread(target = receive,
+                                args = (sqs, event['input'], work, threads, context,
+                                        rate, event.get('start')),
+                                kwargs = {'stop': event.get('stop'),
+                                          'until': event.get('until'),
+                                          'profile': event.get('profile'),
+                                          'begin': begin,
+                                          'slots': range(event.get('worker', 0) * threads,
+                                                         (event.get('worker', 0) + 1) * threads)})]
+    for i in range(threads):
+        workers.append(threading.Thread(target = download,
+                                        args = (batch, headers, identity, work, done,
+                                                event.get('worker', 0) * threads + i,
+                                                event.get('profile'), event.get('start'),
+                                                event.get('decode', False), event.get('stop'))))
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    # Delete finished messages in batches, flushing a partial batch if it has
+    # waited long enough that the messages could become visible again
+    receipts = []
+    flushed = now()
+    finished = 0
+    while finished < threads:
+        try:
+            receipt = done.get(timeout = 1)
+            if receipt is None:
+                finished += 1
+            else:
+                receipts.append(receipt)
+        except Empty:
+            pass
+        batch.flush()
+
+        if len(receipts) >= SQS_BATCH_SIZE or (receipts and now() - flushed > DELETE_INTERVAL):
+            delete_messages(sqs, event['input'], receipts[:SQS_BATCH_SIZE])
+            receipts = receipts[SQS_BATCH_SIZE:]
+            flushed = now()
+
+    # Send the last results, then delete their input messages
+    batch.flush(force = True)
+    while not done.empty():
+        receipts.append(done.get())
+    while len(receipts) > 0:
+        delete_messages(sqs, event['input'], receipts[:SQS_BATCH_SIZE])
+        receipts = receipts[SQS_BATCH_SIZE:]
 
+    if event.get('stop') is not None:
+        release_messages(sqs, event['input'], drain(work, workers[0]))
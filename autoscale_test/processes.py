@@ -1,10 +1,18 @@
+import os
 import json
 import signal
 import time
+import importlib
+import threading
+
+from queue import Queue, Empty
 
 from boto3.session import Session
 from botocore.client import Config
 
+from stats import Stats, Timeline, window_stats
+from profiles import concurrency
+
 def launch_lambda(queue, session_args, token, urls):
     session = Session(**session_args)
     config = Config(read_timeout = 60 * 5)
@@ -19,36 +27,167 @@ def launch_lambda(queue, session_args, token, urls):
     #print(resp['Payload'].read())
     return resp['Payload'].read()
 
-def aggregate(queue, session_args, timeout=60, retry=3):
+class ResultWriter(object):
+    """Summarizes records for the parent process and appends them to a record file
+
+    Partial results are sent to the parent every flush_interval seconds
+    instead of for every record, to keep the histograms off the result queue.
+    Each flush sends (Stats, Timeline, per second Timeline for the live console).
+    """
+
+    def __init__(self, results, records=None, flush_interval=1, window=10):
+        self.results = results
+        self.flush_interval = flush_interval
+        self.window = window
+        self.sink = open(records, 'a') if records else None
+        self.reset()
+
+    def reset(self):
+        self.stats = Stats()
+        self.timeline = Timeline(self.window)
+        self.live = Timeline(1)
+        self.flushed = time.time()
+
+    def add(self, msg):
+        if self.sink:
+            self.sink.write(json.dumps(msg) + '\n')
+        self.stats.add(msg)
+        self.timeline.add(msg)
+        self.live.add(msg)
+
+    def merge(self, timeline, stats):
+        """Add a worker's summary of its records, its timeline and the Stats of all of them"""
+        self.stats.merge(stats)
+        for start, stats_ in timeline.items():
+            # Summaries are only as fine as their windows, count each at its start
+            self.live.windows.setdefault(int(start), window_stats()).merge(stats_)
+        self.timeline.merge(timeline)
+
+    def flush(self, force=False):
+        if not force and time.time() - self.flushed <= self.flush_interval:
+            return
+        if self.stats.count > 0:
+            self.results.put((self.stats, self.timeline, self.live))
+        if self.sink:
+            self.sink.flush()
+        self.reset()
+
+    def close(self):
+        self.flush(force=True)
+        if self.sink:
+            self.sink.close()
+        self.results.put(None) # Signal that this process has finished
+
+def aggregate(queue, session_args, results, received, total_count, idle_timeout=60, flush_interval=1,
+              records=None, window=10):
     signal.signal(signal.SIGINT, signal.SIG_IGN) # Ignore the KeyboardInterrupt
-    total_bytes = 0
-    total_seconds = 0
-    received_count = 0
-    errors = []
 
     session = Session(**session_args)
     sqs = session.resource('sqs')
     queue = sqs.Queue(queue)
 
-    start = time.time()
-    current = time.time()
-    #print("Aggregating results")
-    while retry > 0:# or int(current - start) < timeout:
+    writer = ResultWriter(results, records, flush_interval, window)
+    unpack_result = load_worker().unpack_result
+
+    # Keep draining until every aggregator together has seen total_count
+    # results, or nothing has arrived for idle_timeout seconds
+    last_received = time.time()
+    while received.value < total_count:
+        writer.flush()
+
         msgs = queue.receive_messages(WaitTimeSeconds=20, MaxNumberOfMessages=10)
         if len(msgs) == 0:
-            #print("\tretry")
-            retry -= 1
+            if time.time() - last_received > idle_timeout:
+                break
             continue
-        print('.', end='', flush=True)
+        last_received = time.time()
+
+        queue.delete_messages(Entries = [{'Id': str(i), 'ReceiptHandle': msg.receipt_handle}
+                                         for i, msg in enumerate(msgs)])
+        # Workers send their records in compressed batches, or only summaries
+        count = 0
         for msg in msgs:
-            queue.delete_messages(Entries = [{'Id':'X', 'ReceiptHandle': msg.receipt_handle}])
-            received_count += 1
-            msg = json.loads(msg.body)
-            if 'error' in msg:
-                errors.append(msg['error'])
-            else:
-                total_bytes += msg['bytes']
-                total_seconds += (msg['read_stop'] - msg['req_start'])
-        current = time.time()
-    return (received_count, (total_bytes, total_seconds), errors)
+            records, timeline, stats = unpack_result(msg.body)
+            for record in records:
+                writer.add(record)
+            count += len(records)
+            if timeline is not None:
+                writer.merge(timeline, stats)
+                count += stats.count
+        with received.get_lock():
+            received.value += count
+
+    writer.close()
+
+def load_worker():
+    # lambda is a keyword, so the worker module cannot be named in an import statement
+    return importlib.import_module('lambda')
+
+def local_worker(worker_id, urls, headers, threads, results, flush_interval=1, records=None, window=10,
+                 start=None, offsets=None, profile=None, processes=1, decode=False, limit=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ignore the KeyboardInterrupt
+
+    # Make the same requests as the lambda handler, from this process. If
+    # offsets are given the k-th URL is scheduled for start + offsets[k] (open
+    # loop or trace replay). If a load profile is given, thread j of this process only makes
+    # requests while the profile's concurrency (counted from start) is more
+    # than j * processes + worker_id. The adaptive controller instead sets the
+    # concurrency through the shared limit value.
+    worker = load_worker()
+    # The module may have been imported before this process was forked, so
+    # give each process its own container, as each is its own environment
+    worker.CONTAINER = 'local-{}'.format(os.getpid())
+    writer = ResultWriter(results, records, flush_interval, window)
+    identity = worker.worker_identity(worker_id)
+
+    lock = threading.Lock()
+    items = enumerate(urls)
+    done = Queue()
+    drained = threading.Event() # Every URL has been taken
+
+    def run(slot):
+        while True:
+            if limit is not None and slot >= limit.value:
+                if drained.is_set():
+                    break
+                time.sleep(0.1)
+                continue
+            if profile:
+                target = concurrency(profile, time.time() - start)
+                if target is None:
+                    break
+                if slot >= target:
+                    time.sleep(0.1)
+                    continue
+
+            with lock:
+                item = next(items, None)
+            if item is None:
+                drained.set()
+                break
+
+            i, url = item
+            intended = start + offsets[i] if offsets is not None else None
+            done.put(worker.request(url, headers = headers, identity = identity,
+                                    intended = intended, decode = decode))
+        done.put(None)
+
+    for j in range(threads):
+        thread = threading.Thread(target = run, args = (j * processes + worker_id,))
+        thread.daemon = True
+        thread.start()
 
+    try:
+        running = threads
+        while running > 0:
+            try:
+                msg = done.get(timeout = flush_interval)
+                if msg is None:
+                    running -= 1
+                else:
+                    writer.add(msg)
+            except Empty:
+                pass
+            writer.flush()
+    finally:
+        writer.close()
@@ -0,0 +1,127 @@
+from __future__ import division
+
+import os
+import json
+
+# Load profiles are a list of stages, run one after another. Each stage is
+# given in JSON as
+#     {"type": "ramp", "from": 10, "to": 500, "duration": 600}
+#     {"type": "step", "from": 10, "to": 500, "steps": 5, "duration": 600}
+#     {"type": "hold", "concurrency": 500, "duration": 60}
+#     {"type": "spike", "concurrency": 1000, "duration": 30}
+# or on the command line as a comma separated list of
+#     ramp:<from>:<to>:<duration>
+#     step:<from>:<to>:<duration>:<steps>
+#     hold:<concurrency>:<duration>
+#     spike:<concurrency>:<duration>
+# with durations in seconds. This file is also packaged with the lambda.
+
+STAGE_ARGS = {
+    'ramp': ['from', 'to', 'duration'],
+    'step': ['from', 'to', 'duration', 'steps'],
+    'hold': ['concurrency', 'duration'],
+    'spike': ['concurrency', 'duration'],
+}
+
+def parse_stage(stage):
+    if stage.get('type') not in STAGE_ARGS:
+        raise ValueError("Unknown load profile stage type '{}'".format(stage.get('type')))
+    missing = [arg for arg in STAGE_ARGS[stage['type']] if arg not in stage]
+    if missing:
+        raise ValueError("Load profile {} stage is missing {}".format(stage['type'], ', '.join(missing)))
+
+    if 'concurrency' in stage:
+        start = stop = int(stage['concurrency'])
+    else:
+        start, stop = int(stage['from']), int(stage['to'])
+    return {
+        'type': stage['type'],
+        'from': start,
+        'to': stop,
+        'duration': float(stage['duration']),
+        'steps': int(stage.get('steps', 0)),
+    }
+
+def parse_profile(spec):
+    """Parse a load profile from a JSON file name or a command line spec"""
+    if os.path.isfile(spec):
+        with open(spec, 'r') as fh:
+            stages = json.load(fh)
+    else:
+        stages = []
+        for item in spec.split(','):
+            parts = item.strip().split(':')
+            names = STAGE_ARGS.get(parts[0])
+            if names is None or len(parts) - 1 != len(names):
+                raise ValueError("Could not parse load profile stage '{}'".format(item))
+            stage = dict(zip(names, parts[1:]))
+            stage['type'] = parts[0]
+            stages.append(stage)
+
+    profile = [parse_stage(stage) for stage in stages]
+    if len(profile) == 0:
+        raise ValueError("Load profile has no stages")
+    return profile
+
+def duration(profile):
+    return sum(stage['duration'] for stage in profile)
+
+def peak(profile):
+    return max(max(stage['from'], stage['to']) for stage in profile)
+
+def stage_at(profile, elapsed):
+    """Index of the stage running elapsed seconds into the profile, None when finished"""
+    for i, stage in enumerate(profile):
+        if elapsed < stage['duration']:
+            return i
+        elapsed -= stage['duration']
+    return None
+
+def concurrency(profile, elapsed):
+    """Target number of concurrent requests elapsed seconds into the profile, None when finished"""
+    for stage in profile:
+        if elapsed < stage['duration']:
+            fraction = max(elapsed, 0) / stage['duration']
+            if stage['type'] == 'step':
+                steps = stage['steps']
+                fraction = int(fraction * steps) / (steps - 1) if steps > 1 else 1
+            return int(round(stage['from'] + (stage['to'] - stage['from']) * fraction))
+        elapsed -= stage['duration']
+    return None
+
+def stage_label(stage):
+    if stage['from'] == stage['to']:
+        return "{} {}".format(stage['type'], stage['to'])
+    return "{} {}-{}".format(stage['type'], stage['from'], stage['to'])
+
+def find_knee(points, min_gain=0.25, max_latency=2.0):
+    """Find the saturation knee in a list of (concurrency, requests/sec, p99 seconds)
+
+    The knee is the last concurrency before adding more workers stops adding
+    throughput (the marginal requests/sec per added worker falls below
+    min_gain of the per worker rate at the lowest concurrency) or the p99
+    latency jumps past max_latency times its value at the lowest concurrency.
+    The condition has to hold for two levels in a row so a single noisy window
+    does not count. Returns (knee point, reason) or None if no knee was found.
+    """
+    points = [point for point in points if point[0] > 0 and point[2] is not None]
+    if len(points) < 3:
+        return None
+
+    concurrency_, rate, p99 = points[0]
+    base_rate = rate / concurrency_
+    base_p99 = p99
+
+    previous = None
+    for i in range(1, len(points)):
+        reason = None
+        added = points[i][0] - points[i - 1][0]
+        if added > 0 and (points[i][1] - points[i - 1][1]) / added < min_gain * base_rate:
+            reason = 'throughput stopped rising'
+        elif points[i][2] > max_latency * base_p99:
+            reason = 'p99 latency jumped'
+
+        if reason is not None and previous is not None:
+            return (points[previous - 1], reason)
+        previous = i if reason is not None else None
+    return None
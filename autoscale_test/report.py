@@ -0,0 +1,315 @@
+import os
+import json
+import time
+
+from stats import PERCENTILES, Timeline, window_stats
+from profiles import concurrency, stage_at, stage_label, find_knee
+
+def format_rate(rate):
+    units = 'b/s'
+    for unit in ['Kb/s', 'Mb/s', 'Gb/s', 'Tb/s']:
+        if rate > 1024:
+            rate = rate / 1024
+            units = unit
+    return "{:,} {}".format(int(rate), units)
+
+def print_histogram(name, hist):
+    if hist.count == 0:
+        return
+    values = ["p{} {:.1f}".format(p, hist.percentile(p) * 1000) for p in PERCENTILES]
+    print("\t{:<9} min {:.1f}  {}  max {:.1f}  (ms)".format(name, hist.min * 1000,
+                                                           "  ".join(values), hist.max * 1000))
+
+def print_distribution(hist, width=40):
+    # Collapse the fine grained buckets into power of two millisecond ranges
+    ranges = {}
+    for low, high, count in hist.buckets():
+        key = max(int(low * 1000), 1).bit_length() - 1
+        ranges[key] = ranges.get(key, 0) + count
+    largest = max(ranges.values())
+    for key in sorted(ranges):
+        label = "{:,} - {:,} ms".format(0 if key == 0 else 1 << key, 2 << key)
+        bar = '#' * max(int(width * ranges[key] / largest), 1)
+        print("\t{:>22} {:>9,} {}".format(label, ranges[key], bar))
+
+class LiveConsole(object):
+    """Status line, refreshed while collecting, for the results of the last width seconds
+
+    The rates are computed from per second timelines of the results, by
+    completion time. Results arrive a while after they complete, so the
+    rolling window ends delay seconds ago. The number of requests in flight
+    is estimated as requests/sec x mean latency (Little's law).
+    """
+
+    def __init__(self, width=10, delay=2, interval=1):
+        self.width = width
+        self.delay = delay
+        self.interval = interval
+        self.timeline = Timeline(1)
+        self.printed = 0
+
+    def merge(self, timeline):
+        self.timeline.merge(timeline)
+
+    def update(self, received, force=False):
+        now = time.time()
+        if not force and now - self.printed < self.interval:
+            return
+        self.printed = now
+
+        stop = int(now - self.delay)
+        window = window_stats()
+        for index in list(self.timeline.windows):
+            if index < stop - self.width:
+                del self.timeline.windows[index]
+            elif index < stop:
+                window.merge(self.timeline.windows[index])
+
+        rate = window.count / self.width
+        errors = sum(count for code, count in window.codes.items() if not code.startswith('2'))
+        p99 = window.latency.percentile(99)
+        print("\r{:,} received | last {}s: {:,.1f} req/s  {:,.2f} MB/s  ~{:,.0f} in flight  {:.1%} errors  p99 {}".format(
+                  received, self.width, rate, window.bytes / self.width / 1e6,
+                  rate * (window.latency.mean or 0), errors / window.count if window.count else 0,
+                  "{:,.1f} ms".format(p99 * 1000) if p99 is not None else '-'),
+              end='  ', flush=True)
+
+def profile_windows(timeline, profile, start):
+    """List of (concurrency, stage index, Stats) for each full timeline window of the profile"""
+    results = []
+    for window_start, stats in timeline.items():
+        elapsed = window_start + timeline.width / 2 - start
+        stage = stage_at(profile, elapsed)
+        if elapsed < 0 or stage is None:
+            continue
+        results.append((concurrency(profile, elapsed), stage, stats))
+    return results
+
+def print_stages(timeline, profile, start):
+    windows = profile_windows(timeline, profile, start)
+    report = {'stages': [], 'levels': [], 'knee': None}
+
+    print("Load profile stages")
+    for i, stage in enumerate(profile):
+        stats = window_stats()
+        for concurrency_, stage_, stats_ in windows:
+            if stage_ == i:
+                stats.merge(stats_)
+        rate = stats.count / stage['duration']
+        p99 = stats.latency.percentile(99)
+        print("\t{:<22} {:>7,.1f} req/s {:>12}  p99 {:>9}  {:,} errors".format(
+              stage_label(stage), rate, format_rate(stats.bytes / stage['duration']),
+              "{:.1f} ms".format(p99 * 1000) if p99 is not None else '-', sum(stats.errors.values())))
+        report['stages'].append(dict(stage, count = stats.count, bytes = stats.bytes,
+                                     rate = rate, p99 = p99, errors = sum(stats.errors.values())))
+
+    # Combine every window run at the same concurrency, no matter which stage
+    levels = {}
+    for concurrency_, stage, stats in windows:
+        if concurrency_ not in levels:
+            levels[concurrency_] = (0, window_stats())
+        count, stats_ = levels[concurrency_]
+        levels[concurrency_] = (count + 1, stats_.merge(stats))
+    points = []
+    for concurrency_ in sorted(levels):
+        count, stats = levels[concurrency_]
+        points.append((concurrency_, stats.count / (count * timeline.width), stats.latency.percentile(99)))
+    report['levels'] = [{'concurrency': c, 'rate': r, 'p99': p} for c, r, p in points]
+
+    knee = find_knee(points)
+    if knee is None:
+        print("No saturation knee found")
+    else:
+        (concurrency_, rate, p99), reason = knee
+        print("Saturation knee at {} concurrent requests, {:,.1f} req/s with p99 {:.1f} ms ({} past it)".format(
+              concurrency_, rate, p99 * 1000, reason))
+        report['knee'] = {'concurrency': concurrency_, 'rate': rate, 'p99': p99, 'reason': reason}
+    return report
+
+def print_adaptive(controller):
+    print("Adaptive concurrency steps (p99 SLO {:.1f} ms, at most {:.1%} errors)".format(
+          controller.slo * 1000, controller.max_error_rate))
+    for step in controller.steps:
+        print("\t{:>6,} concurrent {:>9,.1f} req/s {:>12}  p99 {:>9}  {:>6} errors  {}".format(
+              step['concurrency'], step['rate'], format_rate(step['throughput']),
+              "{:.1f} ms".format(step['p99'] * 1000) if step['p99'] is not None else '-',
+              "{:.1%}".format(step['error_rate']) if step['error_rate'] is not None else '-',
+              'ok' if step['sustainable'] else 'breached'))
+
+    best = controller.best()
+    if best is None:
+        print("No concurrency met the SLO")
+    else:
+        print("Max sustainable throughput {} ({:,.1f} req/s) at {} concurrent requests, p99 {:.1f} ms".format(
+              format_rate(best['throughput']), best['rate'], best['concurrency'], best['p99'] * 1000))
+    return {
+        'slo': controller.slo,
+        'max_error_rate': controller.max_error_rate,
+        'steps': controller.steps,
+        'best': best,
+    }
+
+def timeline_report(timeline):
+    return [{
+        'start': window_start,
+        'count': stats.count,
+        'bytes': stats.bytes,
+        'errors': sum(stats.errors.values()),
+        'p50': stats.latency.percentile(50),
+        'p99': stats.latency.percentile(99),
+    } for window_start, stats in timeline.items()]
+
+def print_throughput(stats):
+    """Print the wall clock throughput and concurrency, returns the per second timeline
+
+    Rebuilt from the start and stop of every request: each second's
+    concurrency is the request seconds spent in flight during it, and its
+    throughput the bytes received during it. Long runs are only kept in
+    steps of stats.resolution seconds.
+    """
+    if stats.first is None or stats.last <= stats.first:
+        print("No requests recorded")
+        return []
+
+    wall = stats.last - stats.first
+    step = stats.resolution
+    seconds = range(int(stats.first // step) * step, int(stats.last) + 1, step)
+    # The first and last seconds are only partly covered by the run
+    covered = [min(stats.last, second + step) - max(stats.first, second) for second in seconds]
+    in_flight = [stats.busy.get(second, 0) / cover if cover > 0 else 0
+                 for second, cover in zip(seconds, covered)]
+    mean = sum(stats.busy.values()) / wall
+    peak = max(in_flight)
+    throughput = stats.bytes / wall
+    print("Throughput {} ({:,.1f} req/s) over {:.1f} seconds of wall time".format(
+          format_rate(throughput), stats.count / wall, wall))
+    if stats.sent > 0:
+        print("Upload {} ({:,.1f} writes/sec)".format(format_rate(stats.sent / wall), stats.write.count / wall))
+    print("Concurrency mean {:,.1f}  peak {:,.1f} (busiest {})".format(
+          mean, peak, 'second' if step == 1 else '{} seconds'.format(step)))
+    if mean > 0:
+        print("Efficiency {} ({:,.2f} req/s) per concurrent request".format(
+              format_rate(throughput / mean), stats.count / wall / mean))
+
+    return [{
+        'second': second,
+        'in_flight': busy,
+        'bytes': stats.delivered.get(second, 0),
+    } for second, busy in zip(seconds, in_flight)]
+
+def print_endpoints(stats):
+    wall = stats.last - stats.first if stats.first is not None else 0
+    print("By endpoint")
+    for name, stats_ in sorted(stats.endpoints.items()):
+        p50 = stats_.latency.percentile(50)
+        p99 = stats_.latency.percentile(99)
+        print("\t{:<8} {:>9,} requests {:>9,.1f} req/s {:>12}  p50 {:>9}  p99 {:>9}  {:,} errors".format(
+              name, stats_.count, stats_.count / wall if wall > 0 else 0,
+              format_rate(stats_.bytes / wall) if wall > 0 else '-',
+              "{:.1f} ms".format(p50 * 1000) if p50 is not None else '-',
+              "{:.1f} ms".format(p99 * 1000) if p99 is not None else '-',
+              sum(stats_.errors.values())))
+
+def worker_rate(worker):
+    elapsed = worker['last'] - worker['first']
+    return worker['count'] / elapsed if elapsed > 0 else 0.0
+
+def print_workers(stats, straggler=0.5):
+    """Print the per worker throughput spread, cold start cost and stragglers
+
+    Each worker invocation's rate is its requests over the time from its
+    first request to its last. Stragglers made requests at under straggler
+    times the median rate. Start-up is from the launch of a worker to its
+    first request, so it includes the Lambda cold start.
+    """
+    workers = list(stats.workers.values())
+    rates = sorted(worker_rate(worker) for worker in workers)
+    median = rates[len(rates) // 2]
+    mean = sum(rates) / len(rates)
+    deviation = (sum((rate - mean) ** 2 for rate in rates) / len(rates)) ** 0.5
+    containers = set(worker['container'] for worker in workers)
+    print("Workers: {:,} invocations in {:,} containers".format(len(workers), len(containers)))
+    print("\tRate per worker  min {:,.1f}  p50 {:,.1f}  p90 {:,.1f}  max {:,.1f} req/s  (spread {:.0%} of the mean)".format(
+          rates[0], median, rates[min(int(len(rates) * 0.9), len(rates) - 1)], rates[-1],
+          deviation / mean if mean > 0 else 0))
+    report = {
+        'invocations': len(workers),
+        'containers': len(containers),
+        'rate': {'min': rates[0], 'median': median, 'max': rates[-1], 'mean': mean, 'deviation': deviation},
+    }
+
+    for cold in [True, False]:
+        group = [worker for worker in workers if worker['cold'] == cold]
+        if len(group) == 0:
+            continue
+        startups = [worker['first'] - worker['launched'] for worker in group if worker['launched'] is not None]
+        startup = sum(startups) / len(startups) if startups else None
+        latency = sum(worker['busy'] for worker in group) / max(sum(worker['count'] for worker in group), 1)
+        rate = sum(worker_rate(worker) for worker in group) / len(group)
+        print("\t{} {:>7,} invocations  start-up {:>11}  latency {:,.1f} ms  {:,.1f} req/s (means)".format(
+              'Cold' if cold else 'Warm', len(group),
+              "{:,.0f} ms".format(startup * 1000) if startup is not None else '-', latency * 1000, rate))
+        report['cold' if cold else 'warm'] = {'invocations': len(group), 'startup': startup,
+                                              'latency': latency, 'rate': rate}
+
+    # Stragglers sharing a container point at the client side (a noisy
+    # neighbour or an overloaded worker) rather than at the server
+    slow = sorted((worker for worker in workers if worker_rate(worker) < straggler * median), key = worker_rate)
+    shared = [worker for worker in slow
+              if sum(1 for other in slow if other['container'] == worker['container']) > 1]
+    print("\t{:,} stragglers under {:.0%} of the median rate, {:,} of them sharing a container".format(
+          len(slow), straggler, len(shared)))
+    for worker in slow[:10]:
+        print("\t\tworker {}  container {}  {:,.1f} req/s  latency {:,.1f} ms  {:,} errors{}".format(
+              worker['worker'], worker['container'], worker_rate(worker),
+              worker['busy'] / worker['count'] * 1000, worker['errors'], '  cold' if worker['cold'] else ''))
+    report['stragglers'] = slow
+    return report
+
+def print_report(stats, timeline, total_time, output_dir=None, profile=None, start=None, controller=None):
+    print("Elapsed time: {} seconds".format(total_time))
+    print("Received {:,} messages".format(stats.count))
+    print("Number of errors {:,}".format(sum(stats.errors.values())))
+    for error, count in stats.errors.most_common():
+        print("\t{} x '{}'".format(count, error))
+    print("Response codes")
+    for code, count in sorted(stats.codes.items()):
+        print("\t{} x {}".format(count, code))
+    concurrency_report = print_throughput(stats)
+    print("Latency")
+    print_histogram('Total', stats.latency)
+    if stats.write.count > 0:
+        print_histogram('Reads', stats.read)
+        print_histogram('Writes', stats.write)
+    print_histogram('TTFB', stats.ttfb)
+    print_histogram('Transfer', stats.transfer)
+    print_histogram('Corrected', stats.corrected)
+    print_histogram('Send lag', stats.lag)
+    print_histogram('DNS', stats.dns)
+    print_histogram('Connect', stats.connect)
+    print_histogram('TLS', stats.tls)
+    print_histogram('Decode', stats.decode)
+    if stats.count > 0:
+        print("\t{:,} new connections, {:,} requests reused a connection".format(stats.connect.count, stats.reused))
+    if stats.endpoints and len(stats.endpoints) > 1:
+        print_endpoints(stats)
+    worker_report = None
+    if stats.workers and len(stats.workers) > 1:
+        worker_report = print_workers(stats)
+    if stats.latency.count > 0:
+        print("Latency distribution")
+        print_distribution(stats.latency)
+
+    report = dict(stats.to_dict(), elapsed = total_time, timeline = timeline_report(timeline),
+                  concurrency = concurrency_report, worker_summary = worker_report)
+    if profile is not None:
+        report['profile'] = print_stages(timeline, profile, start)
+    if controller is not None:
+        report['adaptive'] = print_adaptive(controller)
+
+    if output_dir is not None:
+        filename = os.path.join(output_dir, 'report.json')
+        with open(filename, 'w') as fh:
+            json.dump(report, fh, indent=4)
+        print("Report and records saved to {}".format(output_dir))
+    print()
@@ -2,9 +2,50 @@ import io
 import zipfile
 import time
 import json
+import base64
+import hashlib
 
 from contextlib import contextmanager
 
+# Modules imported by lambda.py, packaged with it
+SHARED_MODULES = ['profiles.py', 'stats.py']
+
+# Names of the resources, shared by the per run and persistent resources
+NAME = 'AutoScaleTest'
+RESULTS_QUEUE = 'AutoScaleTestResults'
+URLS_QUEUE = 'AutoScaleTestUrls'
+
+# Tag marking the resources kept between runs by --persistent
+TAG_KEY = 'autoscale-test'
+TAG_VALUE = 'persistent'
+
+ASSUME_ROLE_POLICY = {
+    'Version': '2012-10-17',
+    'Statement': [{
+        'Effect': 'Allow',
+        'Principal': {
+            'Service': 'lambda.amazonaws.com',
+        },
+        'Action': 'sts:AssumeRole',
+    }]
+}
+
+QUEUE_POLICY = {
+    'Version': '2012-10-17',
+    'Statement': [{
+        'Effect': 'Allow',
+        'Action': [
+            'sqs:SendMessage',
+            'sqs:ReceiveMessage',
+            'sqs:DeleteMessage',
+            'sqs:ChangeMessageVisibility',
+        ],
+        'Resource': [
+            '*'
+        ],
+    }]
+}
+
 @contextmanager
 def create_queue(session, name):
     sqs = session.resource('sqs')
@@ -24,39 +65,14 @@ def create_queue(session, name):
 
 @contextmanager
 def create_role(session):
-    policy = {
-        'Version': '2012-10-17',
-        'Statement': [{
-            'Effect': 'Allow',
-            'Principal': {
-                'Service': 'lambda.amazonaws.com',
-            },
-            'Action': 'sts:AssumeRole',
-        }]
-    }
     client = session.client('iam')
     resp = client.create_role(RoleName = 'AutoScaleTest',
-                              AssumeRolePolicyDocument = json.dumps(policy))
+                              AssumeRolePolicyDocument = json.dumps(ASSUME_ROLE_POLICY))
     role_arn = resp['Role']['Arn']
 
     try:
-        policy = {
-            'Version': '2012-10-17',
-            'Statement': [{
-                'Effect': 'Allow',
-                'Action': [
-                    'sqs:SendMessage',
-                    'sqs:ReceiveMessage',
-                    'sqs:DeleteMessage',
-                ],
-                'Resource': [
-                    '*'
-                ],
-            }]
-        }
-
         resp = client.create_policy(PolicyName = 'AutoScaleTest',
-                                    PolicyDocument = json.dumps(policy))
+                                    PolicyDocument = json.dumps(QUEUE_POLICY))
         policy_arn = resp['Policy']['Arn']
 
         try:
@@ -75,8 +91,8 @@ def create_role(session):
     finally:
         resp = client.delete_role(RoleName = 'AutoScaleTest')
 
-@contextmanager
-def create_lambda(session, role, timeout):
+def package_lambda():
+    """Zip file with the lambda code, the same bytes as long as the code is the same"""
     with open('lambda.py', 'r') as fh:
         lambda_code = fh.read().replace('"', '\"').replace('\\', '\\\\')
 
@@ -85,8 +101,17 @@ def create_lambda(session, role, timeout):
     archive_file = zipfile.ZipInfo('index.py')
     archive_file.external_attr = 0o777 << 16
     archive.writestr(archive_file, lambda_code)
+    for module in SHARED_MODULES:
+        with open(module, 'r') as fh:
+            archive_file = zipfile.ZipInfo(module)
+            archive_file.external_attr = 0o777 << 16
+            archive.writestr(archive_file, fh.read())
     archive.close()
-    lambda_code = code.getvalue()
+    return code.getvalue()
+
+@contextmanager
+def create_lambda(session, role, timeout):
+    lambda_code = package_lambda()
 
     client = session.client('lambda')
     resp = client.create_function(FunctionName = 'AutoScaleTest',
@@ -103,3 +128,149 @@ def create_lambda(session, role, timeout):
     finally:
         resp = client.delete_function(FunctionName = 'AutoScaleTest')
 
+@contextmanager
+def create_resources(session, timeout):
+    """Create the queues, role and lambda for a single run, deleting them afterwards
+
+    Yields (results queue, URL queue, lambda ARN).
+    """
+    with create_queue(session, RESULTS_QUEUE) as queue:
+        with create_queue(session, URLS_QUEUE) as url_queue:
+            with create_role(session) as role:
+                with create_lambda(session, role, timeout) as target:
+                    yield queue, url_queue, target
+
+def check_tags(tags, kind, name):
+    if tags.get(TAG_KEY) != TAG_VALUE:
+        raise Exception("{} {} exists but was not created by --persistent, remove it with --teardown".format(kind, name))
+
+def persistent_queue(session, name):
+    """Find the tagged queue or create it, purging any messages left by an earlier run"""
+    client = session.client('sqs')
+    try:
+        url = client.get_queue_url(QueueName = name)['QueueUrl']
+    except client.exceptions.QueueDoesNotExist:
+        url = client.create_queue(QueueName = name, tags = {TAG_KEY: TAG_VALUE})['QueueUrl']
+        return session.resource('sqs').Queue(url)
+    check_tags(client.list_queue_tags(QueueUrl = url).get('Tags', {}), 'Queue', name)
+
+    names = ['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible', 'ApproximateNumberOfMessagesDelayed']
+    attributes = client.get_queue_attributes(QueueUrl = url, AttributeNames = names)['Attributes']
+    left = sum(int(attributes.get(name_, 0)) for name_ in names)
+    if left > 0:
+        # Messages sent while a purge is running may also be deleted, so wait
+        # for the purge to finish before the queue is used
+        print("\tPurging {:,} messages from {}, waiting 60 seconds".format(left, name))
+        try:
+            client.purge_queue(QueueUrl = url)
+        except client.exceptions.PurgeQueueInProgress:
+            pass
+        time.sleep(60)
+    return session.resource('sqs').Queue(url)
+
+def persistent_role(session):
+    """Find the tagged role or create it, updating its policy to the current one"""
+    client = session.client('iam')
+    try:
+        role_arn = client.get_role(RoleName = NAME)['Role']['Arn']
+        created = False
+    except client.exceptions.NoSuchEntityException:
+        resp = client.create_role(RoleName = NAME,
+                                  AssumeRolePolicyDocument = json.dumps(ASSUME_ROLE_POLICY),
+                                  Tags = [{'Key': TAG_KEY, 'Value': TAG_VALUE}])
+        role_arn = resp['Role']['Arn']
+        created = True
+
+    if not created:
+        tags = {tag['Key']: tag['Value'] for tag in client.list_role_tags(RoleName = NAME)['Tags']}
+        check_tags(tags, 'Role', NAME)
+
+    # put_role_policy replaces the policy, so changes to QUEUE_POLICY also
+    # reach a role created by an earlier version of this script
+    client.put_role_policy(RoleName = NAME,
+                           PolicyName = NAME,
+                           PolicyDocument = json.dumps(QUEUE_POLICY))
+    if created:
+        time.sleep(6) # wait for role to become avalable to lambda
+    return role_arn
+
+def persistent_lambda(session, role, timeout):
+    """Find the tagged lambda or create it, only uploading the code if it changed"""
+    lambda_code = package_lambda()
+    code_hash = base64.b64encode(hashlib.sha256(lambda_code).digest()).decode('ascii')
+
+    client = session.client('lambda')
+    try:
+        resp = client.get_function(FunctionName = NAME)
+    except client.exceptions.ResourceNotFoundException:
+        resp = client.create_function(FunctionName = NAME,
+                                      Runtime = 'python2.7',
+                                      Role = role,
+                                      Handler = 'index.handler',
+                                      Code = {'ZipFile': lambda_code},
+                                      Description = 'AutoScale test lambda',
+                                      Timeout = timeout,
+                                      MemorySize = 128, # MBs, multiple of 64
+                                      Tags = {TAG_KEY: TAG_VALUE})
+        client.get_waiter('function_active').wait(FunctionName = NAME)
+        return resp['FunctionArn']
+
+    check_tags(resp.get('Tags', {}), 'Lambda', NAME)
+    config = resp['Configuration']
+    if config['CodeSha256'] != code_hash:
+        print("\tUpdating the lambda code")
+        client.update_function_code(FunctionName = NAME, ZipFile = lambda_code)
+        client.get_waiter('function_updated').wait(FunctionName = NAME)
+    if config['Timeout'] != timeout or config['Role'] != role:
+        client.update_function_configuration(FunctionName = NAME, Timeout = timeout, Role = role)
+        client.get_waiter('function_updated').wait(FunctionName = NAME)
+    return config['FunctionArn']
+
+@contextmanager
+def persistent_resources(session, timeout):
+    """Reuse the resources kept between runs, creating any that are missing
+
+    Yields (results queue, URL queue, lambda ARN), like create_resources(),
+    but leaves everything in place for the next run. Use teardown() to
+    delete them.
+    """
+    queue = persistent_queue(session, RESULTS_QUEUE)
+    url_queue = persistent_queue(session, URLS_QUEUE)
+    role = persistent_role(session)
+    yield queue, url_queue, persistent_lambda(session, role, timeout)
+
+def teardown(session):
+    """Delete the persistent resources, and any left behind by an interrupted run"""
+    sqs = session.client('sqs')
+    for name in [RESULTS_QUEUE, URLS_QUEUE]:
+        try:
+            sqs.delete_queue(QueueUrl = sqs.get_queue_url(QueueName = name)['QueueUrl'])
+            print("\tDeleted queue {}".format(name))
+        except sqs.exceptions.QueueDoesNotExist:
+            pass
+
+    client = session.client('lambda')
+    try:
+        client.delete_function(FunctionName = NAME)
+        print("\tDeleted lambda {}".format(NAME))
+    except client.exceptions.ResourceNotFoundException:
+        pass
+
+    iam = session.client('iam')
+    try:
+        for policy in iam.list_attached_role_policies(RoleName = NAME)['AttachedPolicies']:
+            iam.detach_role_policy(RoleName = NAME, PolicyArn = policy['PolicyArn'])
+        for policy in iam.list_role_policies(RoleName = NAME)['PolicyNames']:
+            iam.delete_role_policy(RoleName = NAME, PolicyName = policy)
+        iam.delete_role(RoleName = NAME)
+        print("\tDeleted role {}".format(NAME))
+    except iam.exceptions.NoSuchEntityException:
+        pass
+
+    # The managed policy of the per run role
+    account = session.client('sts').get_caller_identity()['Account']
+    try:
+        iam.delete_policy(PolicyArn = 'arn:aws:iam::{}:policy/{}'.format(account, NAME))
+        print("\tDeleted policy {}".format(NAME))
+    except iam.exceptions.NoSuchEntityException:
+        pass
@@ -0,0 +1,455 @@
+from __future__ import division
+
+from collections import Counter
+
+# This file is also packaged with the lambda, so workers can send summaries
+
+PERCENTILES = [50, 90, 99, 99.9]
+MAX_ERRORS = 100 # Distinct error messages kept before they are counted together
+OTHER_ERRORS = 'Other errors'
+WORKER_FIELDS = ['worker', 'container', 'cold', 'launched', 'invoked'] # Identity of the worker invocation
+HISTOGRAMS = ['latency', 'read', 'write', 'ttfb', 'transfer', 'corrected', 'lag', 'dns', 'connect', 'tls', 'decode']
+WINDOW_HISTOGRAMS = ['latency'] # Histograms kept for each timeline window
+MAX_SECONDS = 20000 # Entries of busy and delivered kept before each covers twice as many seconds
+
+class Histogram(object):
+    """Log-linear (HDR style) histogram of durations
+
+    Values are stored as integer microseconds. Values below 2**precision get
+    their own bucket, above that every power of two is split into 2**precision
+    buckets, so the relative error of any reported value is below
+    1 / 2**precision while the number of buckets stays fixed. Histograms with
+    the same precision can be merged by adding their bucket counts.
+    """
+
+    def __init__(self, precision=6, max_value=3600):
+        self.precision = precision
+        self.max_value = max_value
+        self.sub_buckets = 1 << precision
+        self.max_index = self._index(int(max_value * 1e6))
+        self.counts = {} # bucket index -> count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return value
+        shift = value.bit_length() - self.precision - 1
+        return shift * self.sub_buckets + (value >> shift)
+
+    def _bounds(self, index):
+        if index < self.sub_buckets:
+            return (index, index + 1)
+        shift = index // self.sub_buckets - 1
+        mantissa = index - shift * self.sub_buckets
+        return (mantissa << shift, (mantissa + 1) << shift)
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        index = min(self._index(value), self.max_index)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge histograms with different precisions")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Value (in seconds) that percent of the recorded values are at or below"""
+        if self.count == 0:
+            return None
+        target = self.count * percent / 100
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                low, high = self._bounds(index)
+                value = (low + high) / 2 / 1e6
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def buckets(self):
+        """List of (low seconds, high seconds, count) for every non-empty bucket"""
+        results = []
+        for index in sorted(self.counts):
+            low, high = self._bounds(index)
+            results.append((low / 1e6, high / 1e6, self.counts[index]))
+        return results
+
+    def to_dict(self):
+        return {
+            'precision': self.precision,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'percentiles': {str(p): self.percentile(p) for p in PERCENTILES},
+            'buckets': self.buckets(),
+        }
+
+    def to_state(self):
+        """JSON serializable state, that from_state() rebuilds the histogram from"""
+        return {
+            'precision': self.precision,
+            'max_value': self.max_value,
+            'counts': self.counts,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        hist = cls(state['precision'], state['max_value'])
+        hist.counts = {int(index): count for index, count in state['counts'].items()}
+        hist.count = state['count']
+        hist.total = state['total']
+        hist.min = state['min']
+        hist.max = state['max']
+        return hist
+
+def spread(seconds, start, stop, amount, resolution=1):
+    """Add amount to the seconds dict, split by how much of start - stop falls in each entry
+
+    Each entry covers resolution seconds and is keyed by its first second.
+    """
+    if stop <= start:
+        index = int(start // resolution) * resolution
+        seconds[index] = seconds.get(index, 0) + amount
+        return
+    for index in range(int(start // resolution) * resolution, int(stop) + 1, resolution):
+        overlap = min(stop, index + resolution) - max(start, index)
+        if overlap > 0:
+            seconds[index] = seconds.get(index, 0) + amount * overlap / (stop - start)
+
+def endpoint(url):
+    """Name of the API endpoint of a request URL, like cutout, tile or image"""
+    parts = url.split('/')
+    return parts[4] if len(parts) > 4 else 'other'
+
+def worker_key(msg):
+    # Worker ids repeat when lambdas are relaunched, invocations do not
+    return str(msg.get('invocation', msg.get('worker')))
+
+def merge_worker(worker, other):
+    for name in ['count', 'errors', 'bytes', 'busy']:
+        worker[name] += other[name]
+    worker['first'] = min(worker['first'], other['first'])
+    worker['last'] = max(worker['last'], other['last'])
+
+def merge_seconds(seconds, other, resolution=1):
+    # Resolutions are powers of two, so each entry of other falls in one entry of seconds
+    for index, amount in other.items():
+        index = index // resolution * resolution
+        seconds[index] = seconds.get(index, 0) + amount
+    return seconds
+
+class Stats(object):
+    """Mergeable summary of request records
+
+    Without breakdown there are no per endpoint, per worker and per second
+    (busy and delivered) breakdowns, and only the listed histograms are
+    recorded, the others are None. Timeline windows are kept that way, so
+    a long run does not hold a full Stats for every window.
+    """
+
+    def __init__(self, breakdown=True, histograms=HISTOGRAMS):
+        self.count = 0
+        self.bytes = 0
+        self.first = None # Earliest request start
+        self.last = None # Latest request stop
+        self.resolution = 1 # Seconds covered by each entry of busy and delivered, doubled past MAX_SECONDS entries
+        self.busy = {} if breakdown else None # second -> request seconds spent in flight, the mean concurrency during it
+        self.delivered = {} if breakdown else None # second -> response bytes received, spread over each transfer
+        self.codes = Counter()
+        self.errors = Counter()
+        self.latency = Histogram() # Request sent to body received
+        self.read = Histogram() # Latency of the GET requests
+        self.write = Histogram() # Latency of the POST requests
+        self.sent = 0 # Bytes of data POSTed
+        self.ttfb = Histogram() # Request sent to response headers received
+        self.transfer = Histogram() # Response headers to body received
+        self.corrected = Histogram() # Open loop, scheduled send time to response received
+        self.lag = Histogram() # Open loop, scheduled send time to actual send time
+        self.dns = Histogram() # New connection, resolving the host name
+        self.connect = Histogram() # New connection, TCP connect, not part of the latency
+        self.tls = Histogram() # New connection, TLS handshake
+        self.decode = Histogram() # Client side decompression of the response
+        self.reused = 0 # Requests made on an already open connection
+        self.endpoints = {} if breakdown else None # endpoint name -> Stats of its requests
+        self.workers = {} if breakdown else None # worker invocation -> identity and totals of its requests
+        self.histograms = [name for name in HISTOGRAMS if name in histograms]
+        for name in HISTOGRAMS:
+            if name not in self.histograms:
+                setattr(self, name, None)
+
+    def record(self, name, seconds):
+        if name in self.histograms:
+            getattr(self, name).record(seconds)
+
+    def coarsen(self, resolution):
+        """Make each entry of busy and delivered cover resolution seconds"""
+        self.busy = merge_seconds({}, self.busy, resolution)
+        self.delivered = merge_seconds({}, self.delivered, resolution)
+        self.resolution = resolution
+
+    def add(self, msg):
+        self.count += 1
+        self.codes[str(msg.get('code', 'error'))] += 1
+        if 'error' in msg:
+            self.add_error(msg['error'])
+
+        self.first = msg['start'] if self.first is None else min(self.first, msg['start'])
+        self.last = msg['stop'] if self.last is None else max(self.last, msg['stop'])
+        if self.busy is not None:
+            spread(self.busy, msg['start'], msg['stop'], msg['stop'] - msg['start'], self.resolution)
+            if 'read_stop' in msg:
+                spread(self.delivered, msg['read_start'], msg['read_stop'], msg['bytes'], self.resolution)
+            if len(self.busy) > MAX_SECONDS:
+                self.coarsen(self.resolution * 2)
+
+        latency = None
+        if 'read_stop' in msg:
+            self.bytes += msg['bytes']
+            latency = msg['read_stop'] - msg['req_start']
+            self.record('ttfb', msg['req_stop'] - msg['req_start'])
+            self.record('transfer', msg['read_stop'] - msg['read_start'])
+        elif 'error_start' in msg:
+            # HTTP error, the response was received but there is no body
+            latency = msg['error_start'] - msg['req_start']
+            self.record('ttfb', msg['error_start'] - msg['req_start'])
+        if latency is not None:
+            self.record('latency', latency)
+            self.record('write' if msg.get('method') == 'POST' else 'read', latency)
+        self.sent += msg.get('sent', 0)
+
+        if 'dns_stop' in msg:
+            self.record('dns', msg['dns_stop'] - msg['dns_start'])
+        if 'connect_stop' in msg:
+            self.record('connect', msg['connect_stop'] - msg['connect_start'])
+        if 'tls_stop' in msg:
+            self.record('tls', msg['tls_stop'] - msg['tls_start'])
+        if 'decode_stop' in msg:
+            self.record('decode', msg['decode_stop'] - msg['decode_start'])
+        if msg.get('reused'):
+            self.reused += 1
+
+        if self.endpoints is not None:
+            name = endpoint(msg.get('url', ''))
+            if name not in self.endpoints:
+                self.endpoints[name] = Stats(breakdown=False)
+            self.endpoints[name].add(msg)
+
+        if self.workers is not None:
+            key = worker_key(msg)
+            if key not in self.workers:
+                self.workers[key] = dict({name: msg.get(name) for name in WORKER_FIELDS},
+                                         count = 0, errors = 0, bytes = 0, busy = 0.0,
+                                         first = msg['start'], last = msg['stop'])
+            merge_worker(self.workers[key], {
+                'count': 1,
+                'errors': 1 if 'error' in msg else 0,
+                'bytes': msg.get('bytes', 0),
+                'busy': msg['stop'] - msg['start'],
+                'first': msg['start'],
+                'last': msg['stop'],
+            })
+
+        # Measuring from the scheduled time instead of the actual send time
+        # corrects for coordinated omission when the workers fall behind
+        if 'intended' in msg:
+            self.record('lag', msg['start'] - msg['intended'])
+            self.record('corrected', msg['stop'] - msg['intended'])
+
+    def add_error(self, error, count=1):
+        if error not in self.errors and len(self.errors) >= MAX_ERRORS:
+            error = OTHER_ERRORS
+        self.errors[error] += count
+
+    def merge(self, other):
+        self.count += other.count
+        self.bytes += other.bytes
+        self.sent += other.sent
+        if other.first is not None:
+            self.first = other.first if self.first is None else min(self.first, other.first)
+            self.last = other.last if self.last is None else max(self.last, other.last)
+        if self.busy is not None and other.busy is not None:
+            if other.resolution > self.resolution:
+                self.coarsen(other.resolution)
+            merge_seconds(self.busy, other.busy, self.resolution)
+            merge_seconds(self.delivered, other.delivered, self.resolution)
+            if len(self.busy) > MAX_SECONDS:
+                self.coarsen(self.resolution * 2)
+        self.codes.update(other.codes)
+        for error, count in other.errors.items():
+            self.add_error(error, count)
+        for name in self.histograms:
+            if name in other.histograms:
+                getattr(self, name).merge(getattr(other, name))
+        self.reused += other.reused
+        if self.endpoints is not None and other.endpoints is not None:
+            for name, stats in other.endpoints.items():
+                if name not in self.endpoints:
+                    self.endpoints[name] = Stats(breakdown=False)
+                self.endpoints[name].merge(stats)
+        if self.workers is not None and other.workers is not None:
+            for key, worker in other.workers.items():
+                if key in self.workers:
+                    merge_worker(self.workers[key], worker)
+                else:
+                    self.workers[key] = dict(worker)
+        return self
+
+    def to_dict(self):
+        results = {
+            'count': self.count,
+            'bytes': self.bytes,
+            'sent': self.sent,
+            'first': self.first,
+            'last': self.last,
+            'codes': dict(self.codes),
+            'errors': dict(self.errors),
+            'reused': self.reused,
+            'endpoints': {name: stats.to_dict() for name, stats in (self.endpoints or {}).items()},
+            'workers': self.workers or {},
+        }
+        for name in self.histograms:
+            results[name] = getattr(self, name).to_dict()
+        return results
+
+    def to_state(self):
+        """JSON serializable state, that from_state() rebuilds the stats from"""
+        state = {
+            'count': self.count,
+            'bytes': self.bytes,
+            'sent': self.sent,
+            'first': self.first,
+            'last': self.last,
+            'codes': dict(self.codes),
+            'errors': dict(self.errors),
+            'reused': self.reused,
+            'histograms': self.histograms,
+        }
+        for name in self.histograms:
+            state[name] = getattr(self, name).to_state()
+        if self.busy is not None:
+            state['resolution'] = self.resolution
+            state['busy'] = {str(index): amount for index, amount in self.busy.items()}
+            state['delivered'] = {str(index): amount for index, amount in self.delivered.items()}
+        if self.endpoints is not None:
+            state['endpoints'] = {name: stats.to_state() for name, stats in self.endpoints.items()}
+        if self.workers is not None:
+            state['workers'] = self.workers
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        stats = cls(breakdown='endpoints' in state, histograms=state['histograms'])
+        stats.count = state['count']
+        stats.bytes = state['bytes']
+        stats.sent = state['sent']
+        stats.first = state['first']
+        stats.last = state['last']
+        stats.codes = Counter(state['codes'])
+        stats.errors = Counter(state['errors'])
+        stats.reused = state['reused']
+        for name in stats.histograms:
+            setattr(stats, name, Histogram.from_state(state[name]))
+        if 'busy' in state:
+            stats.resolution = state['resolution']
+            stats.busy = {int(index): amount for index, amount in state['busy'].items()}
+            stats.delivered = {int(index): amount for index, amount in state['delivered'].items()}
+        if 'endpoints' in state:
+            stats.endpoints = {name: cls.from_state(state_) for name, state_ in state['endpoints'].items()}
+        if 'workers' in state:
+            stats.workers = state['workers']
+        return stats
+
+class Timeline(object):
+    """Mergeable Stats for each window of width seconds, by completion time
+
+    The windows only keep the counts and the latency histogram (see
+    window_stats()). With max_windows, once there are more windows than
+    that pairs of them are merged into windows of twice the width.
+    """
+
+    def __init__(self, width=10, max_windows=None):
+        self.width = width
+        self.max_windows = max_windows
+        self.windows = {} # window index -> Stats
+
+    def add(self, msg):
+        index = int(msg['stop'] // self.width)
+        if index not in self.windows:
+            self.windows[index] = window_stats()
+        self.windows[index].add(msg)
+        self.trim()
+
+    def merge(self, other):
+        """Merge other into this timeline, other's windows have to evenly divide or be a multiple of the width"""
+        if other.width > self.width and other.width % self.width == 0:
+            self.coarsen(other.width // self.width)
+        if self.width % other.width != 0:
+            raise ValueError("Cannot merge timelines with windows of {} and {} seconds".format(self.width, other.width))
+        factor = self.width // other.width
+        for index, stats in other.windows.items():
+            index = index // factor
+            if index in self.windows:
+                self.windows[index].merge(stats)
+            else:
+                self.windows[index] = stats
+        self.trim()
+        return self
+
+    def coarsen(self, factor):
+        """Merge every factor windows into one"""
+        windows = {}
+        for index in sorted(self.windows):
+            if index // factor in windows:
+                windows[index // factor].merge(self.windows[index])
+            else:
+                windows[index // factor] = self.windows[index]
+        self.windows = windows
+        self.width *= factor
+
+    def trim(self):
+        while self.max_windows and len(self.windows) > self.max_windows:
+            self.coarsen(2)
+
+    def items(self):
+        """List of (window start time, Stats) in time order"""
+        return [(index * self.width, self.windows[index]) for index in sorted(self.windows)]
+
+    def to_state(self):
+        return {
+            'width': self.width,
+            'windows': {str(index): stats.to_state() for index, stats in self.windows.items()},
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        timeline = cls(state['width'])
+        timeline.windows = {int(index): Stats.from_state(stats) for index, stats in state['windows'].items()}
+        return timeline
+
+def window_stats():
+    """Stats of one timeline window, without the breakdowns and with only the latency histogram"""
+    return Stats(breakdown=False, histograms=WINDOW_HISTOGRAMS)
@@ -0,0 +1,94 @@
+import time
+import unittest
+
+from controller import Controller
+from stats import Timeline
+
+def step_results(start, seconds, latency, per_second=10, errors=0):
+    """Per second timeline of per_second requests a second, the first errors of them failed"""
+    timeline = Timeline(1)
+    for second in seconds:
+        for i in range(per_second):
+            stop = start + second + (i + 0.5) / per_second
+            msg = {'start': stop - latency, 'stop': stop, 'req_start': stop - latency,
+                   'code': 200, 'bytes': 100}
+            if i < errors:
+                msg.update(code = 500, error = 'Internal Server Error', error_start = stop)
+            else:
+                msg.update(req_stop = stop, read_start = stop, read_stop = stop)
+            timeline.add(msg)
+    return timeline
+
+def ago(seconds=32):
+    # Start of a step that ended, and whose results came in, by now. A whole
+    # second, so the judged windows are exactly the last 20 seconds of it
+    return int(time.time()) - seconds
+
+class ControllerTest(unittest.TestCase):
+    def setUp(self):
+        self.applied = []
+        self.controller = Controller(self.scale, slo = 0.1, interval = 30, delay = 2, settle = 10, maximum = 5)
+        self.controller.start()
+
+    def scale(self, concurrency):
+        self.applied.append(concurrency)
+        return concurrency
+
+    def finish_step(self, started, timeline):
+        self.controller.started = started
+        self.controller.merge(timeline)
+        return self.controller.update()
+
+    def test_waits_for_the_results(self):
+        self.controller.merge(step_results(self.controller.started, range(30), 0.01))
+        self.assertFalse(self.controller.update())
+        self.assertEqual(self.applied, [1])
+
+    def test_increase_and_decrease(self):
+        started = ago()
+        self.assertTrue(self.finish_step(started, step_results(started, range(30), 0.01)))
+        self.assertEqual(self.controller.concurrency, 2)
+
+        step = self.controller.steps[-1]
+        # Only the 20 seconds after settling are judged
+        self.assertEqual((step['count'], step['rate'], step['sustainable']), (200, 10, True))
+        self.assertAlmostEqual(step['in_flight'], 0.1, places = 4)
+
+        started = ago()
+        self.assertTrue(self.finish_step(started, step_results(started, range(30), 0.5)))
+        self.assertEqual(self.controller.concurrency, 1)
+        self.assertFalse(self.controller.steps[-1]['sustainable'])
+        self.assertEqual(self.applied, [1, 2, 1])
+
+    def test_settle_windows_are_not_judged(self):
+        started = ago()
+        timeline = step_results(started, range(10), 0.5)
+        timeline.merge(step_results(started, range(11, 30), 0.01))
+        self.finish_step(started, timeline)
+        self.assertTrue(self.controller.steps[-1]['sustainable'])
+        # Judged windows are dropped
+        self.assertEqual(self.controller.timeline.windows, {})
+
+    def test_error_rate(self):
+        started = ago()
+        self.finish_step(started, step_results(started, range(30), 0.01, errors = 1))
+        step = self.controller.steps[-1]
+        self.assertAlmostEqual(step['error_rate'], 0.1)
+        self.assertFalse(step['sustainable'])
+
+    def test_holds_without_results(self):
+        self.finish_step(ago(), Timeline(1))
+        self.assertEqual(self.controller.concurrency, 1)
+        self.assertIsNone(self.controller.steps[-1]['p99'])
+        self.assertIsNone(self.controller.best())
+
+    def test_limits_and_best(self):
+        for rate in [10, 20, 30, 40, 50, 60]:
+            started = ago()
+            self.finish_step(started, step_results(started, range(30), 0.01, per_second = rate))
+        # Kept at or below maximum
+        self.assertEqual(self.applied, [1, 2, 3, 4, 5, 5, 5])
+        self.assertEqual(self.controller.best()['rate'], 60)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+
+import numpy
+
+try:
+    import cutouts
+    from cutouts import gen_results, parse_endpoints, cutout_share, size_classes, CUBOID_SIZE
+except ImportError: # cutouts needs the intern package
+    cutouts = None
+
+SEQ = [
+    ('api.example.com', 'col', 'exp', 'chan0', 0, (0, 4096, 256, 1024), (0, 2048, 256, 1024), (0, 64, 8, 32), None, 'uint8'),
+    ('api.example.com', 'col', 'exp', 'chan1', 0, (100, 3000, 256, 1024), (0, 1500, 256, 1024), '0:16', None, 'uint16'),
+]
+
+def boxes(workload):
+    return numpy.stack([workload.ranges[axis][i] for axis in 'xyz' for i in range(2)], axis=1)
+
+@unittest.skipIf(cutouts is None, "needs the intern package")
+class DistributionTest(unittest.TestCase):
+    def check_bounds(self, workload):
+        for axis, i in zip('xyz', range(5, 8)):
+            start, stop = workload.ranges[axis]
+            for channel, entry in enumerate(SEQ):
+                c = workload.channels == channel
+                if isinstance(entry[i], tuple):
+                    low, high = entry[i][:2]
+                else:
+                    low, high = map(int, entry[i].split(':'))
+                self.assertTrue((start[c] >= low).all() and (stop[c] <= high).all() and (stop[c] > start[c]).all(), axis)
+
+    def test_uniform(self):
+        workload = gen_results(5000, SEQ, seed = 1)
+        self.check_bounds(workload)
+        size = workload.ranges['x'][1] - workload.ranges['x'][0]
+        self.assertTrue(((size >= 256) & (size <= 1024)).all())
+        # Fixed ranges are kept as they are
+        z = workload.ranges['z']
+        self.assertTrue((z[0][workload.channels == 1] == 0).all() and (z[1][workload.channels == 1] == 16).all())
+        self.assertEqual(workload[1].split('/')[-5:], ['0', '{}:{}'.format(workload.ranges['x'][0][1], workload.ranges['x'][1][1]),
+                                                       '{}:{}'.format(workload.ranges['y'][0][1], workload.ranges['y'][1][1]),
+                                                       '0:16', ''])
+
+    def test_aligned(self):
+        workload = gen_results(2000, SEQ, seed = 2, distribution = 'aligned')
+        self.check_bounds(workload)
+        for axis in 'xy':
+            start, stop = workload.ranges[axis]
+            self.assertTrue((start % CUBOID_SIZE[axis] == 0).all() and (stop % CUBOID_SIZE[axis] == 0).all(), axis)
+
+    def test_hotspot(self):
+        workload = gen_results(20000, SEQ, seed = 3, distribution = 'hotspot', hotspots = 5, zipf = 1.5)
+        self.check_bounds(workload)
+        for channel in range(len(SEQ)):
+            regions, counts = numpy.unique(boxes(workload)[workload.channels == channel], axis=0, return_counts=True)
+            self.assertLessEqual(len(regions), 5)
+            # Zipf popularity, the most popular region gets more than a fair share
+            self.assertGreater(counts.max() / counts.sum(), 0.3)
+        self.assertTrue((workload.ranges['x'][0] % CUBOID_SIZE['x'] == 0).all())
+
+        # The hot regions are the same in every block of the same seed
+        block = gen_results(1000, SEQ, seed = 3, distribution = 'hotspot', hotspots = 5, zipf = 1.5, first = 20000)
+        self.assertTrue(set(map(tuple, boxes(block))) <= set(map(tuple, boxes(workload))))
+
+    def test_raster(self):
+        workload = gen_results(20000, SEQ, seed = 4, distribution = 'raster')
+        self.check_bounds(workload)
+        for channel in range(len(SEQ)):
+            c = workload.channels == channel
+            index = numpy.arange(c.sum())
+            stride = 1
+            # x is swept fastest, one box size at a time, then y and z
+            for axis in 'xyz':
+                start, stop = workload.ranges[axis][0][c], workload.ranges[axis][1][c]
+                size = stop[0] - start[0]
+                positions = len(numpy.unique(start))
+                self.assertTrue((stop - start == size).all())
+                self.assertTrue((start == start.min() + (index // stride % positions) * size).all(), axis)
+                stride *= positions
+            # Every box is visited once in a sweep, then it starts over
+            requests = boxes(workload)[c]
+            self.assertEqual(len(numpy.unique(requests[:stride], axis=0)), stride)
+            self.assertTrue((requests[stride:2 * stride] == requests[:stride]).all())
+
+        # Continued in blocks, the sweep continues
+        block = gen_results(100, SEQ, seed = 4, distribution = 'raster', first = 1000)
+        self.assertTrue((boxes(block) == boxes(workload)[1000:1100]).all())
+
+    def test_reuse(self):
+        workload = gen_results(10000, SEQ, seed = 5, reuse = 0.5)
+        unique = workload.unique()
+        self.assertLess(unique, 6000)
+        self.assertGreater(unique, 4000)
+
+@unittest.skipIf(cutouts is None, "needs the intern package")
+class MixTest(unittest.TestCase):
+    def test_endpoints(self):
+        endpoints = parse_endpoints('cutout:1,tile:3')
+        self.assertEqual(cutout_share(endpoints), 0.25)
+        self.assertEqual(cutout_share(None), 1.0)
+        self.assertRaises(ValueError, parse_endpoints, 'cutout,thumbnail')
+
+        workload = gen_results(4000, SEQ, seed = 6, endpoints = endpoints, orientation = 'xz', tile_size = 512)
+        tiles = [url for url in workload if '/tile/' in url]
+        self.assertAlmostEqual(len(tiles) / len(workload), 0.75, delta = 0.05)
+        # orientation, tile size, resolution, x tile index, y slice, z tile index
+        parts = tiles[0].split('/')[-7:-1]
+        self.assertEqual(parts[:3], ['xz', '512', '0'])
+
+    def test_writes(self):
+        endpoints = parse_endpoints('cutout:1,image:1')
+        workload = gen_results(20000, SEQ, seed = 7, writes = 0.3, endpoints = endpoints)
+        # A fraction of all the requests, all of them cutouts
+        self.assertAlmostEqual(workload.writes.mean(), 0.3, delta = 0.02)
+        self.assertTrue((workload.endpoints[workload.writes] == 0).all())
+
+        post = [url for url in workload[:200] if url.startswith('POST ')]
+        self.assertTrue(post)
+        self.assertTrue(all(url.split(' ')[1] in ('uint8', 'uint16') for url in post))
+
+    def test_size_classes(self):
+        ranges = {'x': (numpy.array([0, 10, 5]), numpy.array([100, 74, 5]))}
+        start, stop = size_classes(ranges, numpy.array([True, True, True]))['x']
+        self.assertEqual((stop - start).tolist(), [64, 64, 0])
+        start, stop = size_classes(ranges, numpy.array([False, True, False]))['x']
+        self.assertEqual((stop - start).tolist(), [100, 64, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import json
+import tempfile
+import unittest
+
+from profiles import parse_profile, duration, peak, stage_at, concurrency, stage_label, find_knee
+
+class ProfileTest(unittest.TestCase):
+    def test_parse_spec(self):
+        profile = parse_profile('ramp:10:50:60, step:50:200:100:4,hold:200:30,spike:500:5')
+        self.assertEqual([stage['type'] for stage in profile], ['ramp', 'step', 'hold', 'spike'])
+        self.assertEqual(profile[1], {'type': 'step', 'from': 50, 'to': 200, 'duration': 100.0, 'steps': 4})
+        self.assertEqual(profile[2]['from'], 200)
+        self.assertEqual((duration(profile), peak(profile)), (195.0, 500))
+        self.assertEqual([stage_label(stage) for stage in profile], ['ramp 10-50', 'step 50-200', 'hold 200', 'spike 500'])
+
+    def test_parse_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix = '.json', delete = False) as fh:
+            json.dump([{'type': 'hold', 'concurrency': 5, 'duration': 10}], fh)
+        try:
+            self.assertEqual(parse_profile(fh.name)[0]['to'], 5)
+        finally:
+            os.remove(fh.name)
+
+    def test_parse_errors(self):
+        self.assertRaises(ValueError, parse_profile, 'ramp:10:50')
+        self.assertRaises(ValueError, parse_profile, 'jump:10:50:60')
+        self.assertRaises(ValueError, parse_profile, '')
+
+    def test_concurrency(self):
+        profile = parse_profile('ramp:0:100:100,step:100:400:40:4,hold:7:10')
+        self.assertEqual(concurrency(profile, -5), 0)
+        self.assertEqual(concurrency(profile, 25), 25)
+        self.assertEqual(concurrency(profile, 99.9), 100)
+        # Four steps of 10 seconds, from 100 to 400
+        self.assertEqual([concurrency(profile, 100 + t) for t in [0, 9.9, 10, 25, 39]], [100, 100, 200, 300, 400])
+        self.assertEqual(concurrency(profile, 145), 7)
+        self.assertIsNone(concurrency(profile, 150))
+        self.assertEqual([stage_at(profile, t) for t in [0, 100, 140, 150]], [0, 1, 2, None])
+
+class KneeTest(unittest.TestCase):
+    def test_throughput_stops_rising(self):
+        points = [(c, 100.0 * min(c, 40), 0.02) for c in [10, 20, 30, 40, 50, 60, 70]]
+        (knee, rate, p99), reason = find_knee(points)
+        self.assertEqual((knee, rate, reason), (40, 4000.0, 'throughput stopped rising'))
+
+    def test_latency_jumps(self):
+        points = [(10, 1000.0, 0.02), (20, 2000.0, 0.03), (30, 3000.0, 0.05), (40, 4000.0, 0.06)]
+        (knee, rate, p99), reason = find_knee(points)
+        self.assertEqual((knee, reason), (20, 'p99 latency jumped'))
+
+    def test_single_noisy_level(self):
+        # One level that does not add throughput is not a knee
+        points = [(10, 1000.0, 0.02), (20, 2000.0, 0.02), (30, 2000.0, 0.02), (40, 4000.0, 0.02), (50, 5000.0, 0.02)]
+        self.assertIsNone(find_knee(points))
+
+    def test_too_few_points(self):
+        self.assertIsNone(find_knee([(10, 1000.0, 0.02), (20, 1000.0, 0.02)]))
+        self.assertIsNone(find_knee([(0, 0.0, None), (10, 10.0, None), (20, 20.0, None), (30, 30.0, 0.1)]))
+
+if __name__ == '__main__':
+    unittest.main()
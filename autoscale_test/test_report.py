@@ -0,0 +1,45 @@
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+
+from report import print_report
+from stats import Stats, Timeline
+from test_stats import records
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_report_file(self):
+        stats, timeline = Stats(), Timeline(1)
+        for msg in records():
+            stats.add(msg)
+            timeline.add(msg)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            print_report(stats, timeline, 5.0, self.directory)
+        self.assertIn("Latency distribution", output.getvalue())
+
+        with open(os.path.join(self.directory, 'report.json')) as fh:
+            report = json.load(fh)
+        self.assertEqual(report['count'], 500)
+        latency = report['latency']
+        self.assertEqual(latency['count'], 500)
+        self.assertEqual(sum(count for low, high, count in latency['buckets']), 500)
+        self.assertEqual(latency['percentiles']['99'], stats.latency.percentile(99))
+        self.assertLessEqual(latency['min'], latency['percentiles']['50'])
+        self.assertLessEqual(latency['percentiles']['50'], latency['percentiles']['99'])
+        self.assertEqual(report['ttfb']['count'], 500)
+        self.assertEqual(report['dns']['count'], 72)
+        self.assertEqual(report['endpoints']['cutout']['latency']['count'], 500)
+        self.assertEqual(sum(window['count'] for window in report['timeline']), 500)
+
+if __name__ == '__main__':
+    unittest.main()
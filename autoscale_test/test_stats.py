@@ -0,0 +1,266 @@
+import os
+import json
+import math
+import random
+import shutil
+import subprocess
+import unittest
+
+import stats
+from stats import Histogram, Stats, Timeline, window_stats
+
+def record(start, latency=0.05, size=1000, code=200, **extra):
+    msg = {
+        'start': start,
+        'stop': start + latency,
+        'req_start': start,
+        'req_stop': start + latency / 2,
+        'read_start': start + latency / 2,
+        'read_stop': start + latency,
+        'bytes': size,
+        'code': code,
+        'url': 'https://api.example.com/v0.7/cutout/col/exp/chan/0/0:512/0:512/0:16/',
+        'worker': 0,
+        'invocation': 'a',
+    }
+    msg.update(extra)
+    return msg
+
+def records(count=500, seed=1):
+    rng = random.Random(seed)
+    results = []
+    for i in range(count):
+        msg = record(1000 + i * 0.01, rng.expovariate(20), rng.randint(1, 10000), worker = i % 3,
+                     invocation = str(i % 3))
+        if i % 7 == 0:
+            msg['dns_start'], msg['dns_stop'] = msg['start'], msg['start'] + 0.001
+            msg['connect_start'], msg['connect_stop'] = msg['start'], msg['start'] + 0.002
+        else:
+            msg['reused'] = True
+        if i % 50 == 0:
+            del msg['read_start'], msg['read_stop']
+            msg['error_start'] = msg['stop']
+            msg['code'] = 500
+            msg['error'] = 'Internal Server Error'
+        results.append(msg)
+    return results
+
+# Run by the Python 2 interpreter, the lambda's runtime
+PY2_SCRIPT = """
+import json, sys
+from stats import Stats, Timeline
+data = json.load(sys.stdin)
+stats = Stats()
+timeline = Timeline(1)
+for msg in data['records']:
+    stats.add(msg)
+    timeline.add(msg)
+print(json.dumps({'stats': stats.to_state(), 'timeline': timeline.to_state(),
+                  'parsed': Stats.from_state(data['state']).to_dict()}))
+"""
+
+def as_json(value):
+    # Compared as JSON, as written to the report, and fast to compare when it differs
+    return json.dumps(value, sort_keys = True)
+
+def find_python2():
+    for python in [os.environ.get('PYTHON2'), shutil.which('python2'), shutil.which('python2.7')]:
+        if python and subprocess.call([python, '-c', 'import json'], stdout = subprocess.DEVNULL,
+                                      stderr = subprocess.DEVNULL) == 0:
+            return python
+    return None
+
+class HistogramTest(unittest.TestCase):
+    def test_percentile_error_bound(self):
+        rng = random.Random(2)
+        for precision in [4, 6, 8]:
+            hist = Histogram(precision)
+            # At least 1 ms, whole microsecond truncation is well below the bound
+            values = sorted(math.exp(rng.uniform(math.log(0.001), math.log(100))) for _ in range(20000))
+            for value in values:
+                hist.record(value)
+            for percent in [1, 10, 50, 90, 99, 99.9, 100]:
+                exact = values[int(math.ceil(len(values) * percent / 100)) - 1]
+                error = abs(hist.percentile(percent) - exact) / exact
+                self.assertLess(error, 1 / 2 ** precision, (precision, percent))
+
+    def test_to_dict(self):
+        hist = Histogram()
+        for value in [0.001, 0.002, 0.002, 0.1]:
+            hist.record(value)
+        summary = json.loads(json.dumps(hist.to_dict()))
+        self.assertEqual((summary['count'], summary['min'], summary['max']), (4, 0.001, 0.1))
+        self.assertAlmostEqual(summary['total'], 0.105)
+        self.assertEqual(sorted(summary['percentiles']), sorted(str(p) for p in stats.PERCENTILES))
+        self.assertAlmostEqual(summary['percentiles']['50'], 0.002, delta = 0.002 / 2 ** 6)
+        self.assertAlmostEqual(summary['percentiles']['99'], 0.1, delta = 0.1 / 2 ** 6)
+        self.assertEqual([count for low, high, count in summary['buckets']], [1, 2, 1])
+        for (low, high, count), value in zip(summary['buckets'], [0.001, 0.002, 0.1]):
+            self.assertTrue(low <= value < high)
+
+    def test_small_values_are_exact(self):
+        hist = Histogram()
+        for micros in range(1, 64):
+            hist.record(micros / 1e6)
+        self.assertEqual([(low, high) for low, high, count in hist.buckets()][:2],
+                         [(1e-6, 2e-6), (2e-6, 3e-6)])
+        self.assertEqual(hist.count, 63)
+
+    def test_clamped_to_recorded_range(self):
+        hist = Histogram()
+        hist.record(0.0105)
+        self.assertEqual(hist.percentile(0), 0.0105)
+        self.assertEqual(hist.percentile(100), 0.0105)
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_merge(self):
+        a, b, both = Histogram(), Histogram(), Histogram()
+        for i in range(1, 1000):
+            (a if i % 2 else b).record(i / 1000)
+            both.record(i / 1000)
+        a.merge(b)
+        self.assertEqual(a.counts, both.counts)
+        self.assertEqual((a.count, a.min, a.max), (both.count, both.min, both.max))
+        self.assertAlmostEqual(a.total, both.total)
+        self.assertRaises(ValueError, a.merge, Histogram(4))
+
+class StatsTest(unittest.TestCase):
+    def test_merge_matches_adding(self):
+        msgs = records()
+        whole, first, second = Stats(), Stats(), Stats()
+        for i, msg in enumerate(msgs):
+            whole.add(msg)
+            (first if i < 200 else second).add(msg)
+        first.merge(second)
+        self.assertEqual(as_json(first.to_dict()), as_json(whole.to_dict()))
+        self.assertEqual(first.to_dict()['latency']['count'], 500)
+        self.assertEqual(first.codes, {'200': 490, '500': 10})
+
+    def test_state_round_trip(self):
+        original = Stats()
+        for msg in records():
+            original.add(msg)
+        restored = Stats.from_state(json.loads(json.dumps(original.to_state())))
+        self.assertEqual(as_json(restored.to_dict()), as_json(original.to_dict()))
+        self.assertEqual(restored.to_dict()['ttfb']['percentiles'], original.ttfb.to_dict()['percentiles'])
+        self.assertEqual(restored.busy, original.busy)
+        self.assertEqual(restored.delivered, original.delivered)
+        self.assertEqual(restored.codes, {'200': 490, '500': 10})
+        self.assertEqual(sorted(restored.workers), ['0', '1', '2'])
+
+    def test_busy_and_delivered(self):
+        stats_ = Stats()
+        stats_.add(record(10.5, latency = 1.0, size = 300))
+        self.assertEqual(stats_.busy, {10: 0.5, 11: 0.5})
+        # The body is received over the second half of the request
+        self.assertEqual(stats_.delivered, {11: 300})
+
+    def test_resolution_is_doubled(self):
+        maximum = stats.MAX_SECONDS
+        stats.MAX_SECONDS = 100
+        try:
+            stats_ = Stats()
+            for i in range(1000):
+                stats_.add(record(1000 + i * 0.7, latency = 0.5))
+            self.assertEqual(stats_.resolution, 8)
+            self.assertLessEqual(len(stats_.busy), 100)
+            self.assertTrue(all(second % 8 == 0 for second in stats_.busy))
+            self.assertAlmostEqual(sum(stats_.busy.values()), 500)
+
+            # Merging keeps the coarser resolution
+            other = Stats()
+            other.add(record(1003, latency = 0.5))
+            other.merge(stats_)
+            self.assertEqual(other.resolution, 8)
+            self.assertAlmostEqual(sum(other.busy.values()), 500.5)
+            restored = Stats.from_state(json.loads(json.dumps(other.to_state())))
+            self.assertEqual((restored.resolution, restored.busy), (8, other.busy))
+        finally:
+            stats.MAX_SECONDS = maximum
+
+    def test_window_stats(self):
+        window = window_stats()
+        for msg in records(50):
+            window.add(msg)
+        self.assertIsNone(window.busy)
+        self.assertIsNone(window.ttfb)
+        self.assertIsNone(window.endpoints)
+        self.assertEqual(window.latency.count, 50)
+
+        state = window.to_state()
+        self.assertNotIn('ttfb', state)
+        self.assertEqual(Stats.from_state(state).histograms, ['latency'])
+
+        # A full Stats only takes the histograms the window has
+        full = Stats().merge(window)
+        self.assertEqual((full.count, full.latency.count, full.ttfb.count), (50, 50, 0))
+
+    @unittest.skipIf(find_python2() is None, "needs a Python 2 interpreter (python2 or PYTHON2)")
+    def test_python2_round_trip(self):
+        msgs = records()
+        stats_, timeline = Stats(), Timeline(1)
+        for msg in msgs:
+            stats_.add(msg)
+            timeline.add(msg)
+
+        directory = os.path.dirname(os.path.abspath(__file__))
+        data = json.dumps({'records': msgs, 'state': stats_.to_state()})
+        output = subprocess.run([find_python2(), '-c', PY2_SCRIPT], input = data.encode('utf-8'),
+                                stdout = subprocess.PIPE, cwd = directory, check = True).stdout
+        result = json.loads(output.decode('utf-8'))
+
+        expected = as_json(stats_.to_dict())
+        # Python 2 summaries read by Python 3, as the aggregators do
+        self.assertEqual(as_json(Stats.from_state(result['stats']).to_dict()), expected)
+        timeline_ = Timeline.from_state(result['timeline'])
+        self.assertEqual([(start, window.count) for start, window in timeline_.items()],
+                         [(start, window.count) for start, window in timeline.items()])
+        # and Python 3 state read by Python 2
+        self.assertEqual(as_json(result['parsed']), expected)
+        self.assertEqual(result['parsed']['latency']['count'], 500)
+
+class TimelineTest(unittest.TestCase):
+    def test_windows(self):
+        timeline = Timeline(10)
+        for msg in records():
+            timeline.add(msg)
+        self.assertEqual([start for start, _ in timeline.items()], [1000])
+        timeline.add(record(1015))
+        self.assertEqual([(start, window.count) for start, window in timeline.items()], [(1000, 500), (1010, 1)])
+
+    def test_max_windows(self):
+        timeline = Timeline(10, 50)
+        for i in range(2000):
+            timeline.add(record(1000 + i))
+        self.assertEqual(timeline.width, 40)
+        self.assertLessEqual(len(timeline.windows), 50)
+        self.assertEqual(sum(window.count for _, window in timeline.items()), 2000)
+        self.assertTrue(all(start % 40 == 0 for start, _ in timeline.items()))
+
+    def test_merge_widths(self):
+        fine, coarse = Timeline(1), Timeline(10)
+        for i in range(100):
+            fine.add(record(1000 + i))
+        coarse.merge(fine)
+        self.assertEqual([window.count for _, window in coarse.items()], [10] * 10)
+
+        # Merging a coarser timeline widens this one
+        fine = Timeline(5)
+        fine.add(record(1000))
+        fine.merge(coarse)
+        self.assertEqual(fine.width, 10)
+        self.assertEqual(fine.items()[0][1].count, 11)
+
+        self.assertRaises(ValueError, Timeline(3).merge, Timeline(2))
+
+    def test_state_round_trip(self):
+        timeline = Timeline(2)
+        for msg in records():
+            timeline.add(msg)
+        restored = Timeline.from_state(json.loads(json.dumps(timeline.to_state())))
+        self.assertEqual(restored.width, 2)
+        self.assertEqual([(start, window.count, window.latency.percentile(99)) for start, window in restored.items()],
+                         [(start, window.count, window.latency.percentile(99)) for start, window in timeline.items()])
+
+if __name__ == '__main__':
+    unittest.main()
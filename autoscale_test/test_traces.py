@@ -0,0 +1,69 @@
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from traces import write_trace, read_trace, trace_from_records
+
+class TraceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        filename = os.path.join(self.directory, 'trace.gz')
+        offsets = [0.0, 0.25, 1.5e-6, 3600.125]
+        workers = [0, 3, 7, 4294967295]
+        urls = ['https://api.example.com/v0.7/cutout/a/b/c/0/0:512/0:512/0:16/',
+                'POST uint16 https://api.example.com/v0.7/cutout/a/b/c/0/0:64/0:64/0:16/',
+                'https://api.example.com/v0.7/tile/a/b/é/xy/512/0/0/0/0/',
+                '']
+        write_trace(filename, offsets, workers, urls)
+
+        offsets_, workers_, urls_ = read_trace(filename)
+        self.assertEqual(offsets_.dtype, numpy.float64)
+        self.assertEqual(offsets_.tolist(), offsets)
+        self.assertEqual(workers_.tolist(), workers)
+        self.assertEqual(urls_, urls)
+
+    def test_empty(self):
+        filename = os.path.join(self.directory, 'empty.gz')
+        write_trace(filename, [], [], [])
+        offsets, workers, urls = read_trace(filename)
+        self.assertEqual((len(offsets), len(workers), urls), (0, 0, []))
+
+    def test_not_a_trace(self):
+        filename = os.path.join(self.directory, 'other.gz')
+        with gzip.open(filename, 'wb') as fh:
+            fh.write(b'something else')
+        self.assertRaises(ValueError, read_trace, filename)
+
+    def test_from_records(self):
+        filename = os.path.join(self.directory, 'records.json')
+        records = [
+            {'url': 'https://h/b', 'start': 105.0, 'stop': 106.0, 'worker': 2},
+            {'url': 'https://h/a', 'start': 101.0, 'intended': 100.5, 'stop': 102.0, 'worker': 1},
+            {'url': 'https://h/c', 'start': 103.0, 'stop': 104.0, 'method': 'POST', 'datatype': 'uint8'},
+            {'count': 1}, # Not a request record
+        ]
+        with open(filename, 'w') as fh:
+            for record in records:
+                fh.write(json.dumps(record) + '\n')
+
+        offsets, workers, urls = trace_from_records([filename])
+        # Ordered by the scheduled (or actual) send time, relative to the first request
+        self.assertEqual(offsets.tolist(), [0.0, 2.5, 4.5])
+        self.assertEqual(workers.tolist(), [1, 0, 2])
+        self.assertEqual(urls, ['https://h/a', 'POST uint8 https://h/c', 'https://h/b'])
+
+        offsets, workers, urls = trace_from_records([])
+        self.assertEqual((len(offsets), urls), (0, []))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import gzip
+import json
+import struct
+
+import numpy
+
+# Trace files are gzip compressed and hold a header followed by one record
+# for each request, in the order they are sent
+MAGIC = b'BOSSTRACE1'
+HEADER = struct.Struct('<Q') # number of requests
+RECORD = struct.Struct('<dIH') # offset from the start (seconds), worker, URL length
+
+def write_trace(filename, offsets, workers, urls):
+    with gzip.open(filename, 'wb') as fh:
+        fh.write(MAGIC)
+        fh.write(HEADER.pack(len(urls)))
+        for offset, worker, url in zip(offsets, workers, urls):
+            url = url.encode('utf-8')
+            fh.write(RECORD.pack(offset, worker, len(url)))
+            fh.write(url)
+
+def read_trace(filename):
+    """Read a trace file, returns (offsets array, workers array, list of URLs)"""
+    with gzip.open(filename, 'rb') as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a trace file".format(filename))
+        count, = HEADER.unpack(fh.read(HEADER.size))
+
+        offsets = numpy.empty(count, dtype=numpy.float64)
+        workers = numpy.empty(count, dtype=numpy.uint32)
+        urls = []
+        for i in range(count):
+            offsets[i], workers[i], length = RECORD.unpack(fh.read(RECORD.size))
+            urls.append(fh.read(length).decode('utf-8'))
+    return offsets, workers, urls
+
+def trace_from_records(filenames):
+    """Build a trace from the record files of a run
+
+    Each request is placed at the time it was scheduled for (open loop) or
+    actually sent (closed loop), relative to the first request. Writes are
+    kept as 'POST <datatype> <URL>', like the generated workloads.
+    """
+    requests = []
+    for filename in filenames:
+        with open(filename, 'r') as fh:
+            for line in fh:
+                msg = json.loads(line)
+                if 'url' not in msg:
+                    continue
+                url = msg['url']
+                if msg.get('method') == 'POST':
+                    url = 'POST {} {}'.format(msg['datatype'], url)
+                requests.append((msg.get('intended', msg['start']), msg.get('worker') or 0, url))
+    requests.sort()
+
+    if len(requests) == 0:
+        return numpy.empty(0), numpy.empty(0, dtype=numpy.uint32), []
+    first = requests[0][0]
+    offsets = numpy.array([r[0] - first for r in requests], dtype=numpy.float64)
+    workers = numpy.array([r[1] for r in requests], dtype=numpy.uint32)
+    return offsets, workers, [r[2] for r in requests]
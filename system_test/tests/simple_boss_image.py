@@ -179,9 +179,9 @@ class SimpleBossImageTest(simple_boss_test.SimpleBossTest):
                 boss_test_utils.get_obj(remote, self.result['url'], accept)
                 if self.delay > 0:
                     time.sleep(self.delay)
-            tick = time.time()
-            obj = boss_test_utils.get_obj(remote, self.result['url'], accept)
-            self.result['read_time'].append(time.time() - tick)
+            obj, phases = boss_test_utils.get_obj_timed(remote, self.result['url'], accept, decode=True)
+            self.result['read_time'].append(phases['total'])
+            boss_test_utils.add_phases(self.result, phases)
             self.result['status_code'] = obj.status_code
         return 1
 
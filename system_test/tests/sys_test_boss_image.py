@@ -16,7 +16,6 @@
 import unittest
 import numpy
 import requests
-import time
 import systemtest
 from utils import boss_test_utils, numpy_utils, plot_utils
 from tests import sys_test_boss__base
@@ -158,9 +157,9 @@ class BossImageSystemTest(sys_test_boss__base.BossSystemTest):
                         self._channel.name,
                         orientation,
                         str(resolution), x_str, y_str, z_str, str("" if not t_str else t_str)]))
-                tick = time.time()
-                obj = boss_test_utils.get_obj(remote, self.result['url'], accept)
-                self.result['duration'].append(time.time() - tick)
+                obj, phases = boss_test_utils.get_obj_timed(remote, self.result['url'], accept, decode=True)
+                self.result['duration'].append(phases['total'])
+                boss_test_utils.add_phases(self.result, phases)
                 self.result['status_code'] = obj.status_code
                 self.assertTrue(obj.ok, 'Bad request: {0}'.format(obj.reason))
                 # self.assertNotIn(obj.status_code, [404, 500, 504], 'Received error status {0}'.format(obj.status_code))
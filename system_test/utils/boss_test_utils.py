@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import requests, time, inspect
+import io, socket, ssl, http.client, urllib.parse
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from intern.remote.boss import BossRemote
 from intern.resource.boss.resource import *
@@ -20,6 +21,9 @@ from intern.resource.boss.resource import *
 # DEFAULT_DOMAIN = 'integration.theboss.io'
 DEFAULT_VERSION = 0.7
 
+# Phases of a timed request, in seconds #
+PHASES = ['dns', 'connect', 'tls', 'ttfb', 'transfer', 'decode']
+
 # Define cache dimensions #
 CACHE_SIZE_X = 512
 CACHE_SIZE_Y = 512
@@ -189,3 +193,98 @@ def get_obj(remote: BossRemote, url: str, format_accept: str='*/*') -> requests.
                'Accept': format_accept,
                'Authorization': 'Token {0}'.format(token)}
     return requests.get(url, params=None, headers=headers)
+
+
+def get_obj_timed(remote: BossRemote, url: str, format_accept: str='*/*', decode=False):
+    """GET request on a new connection, timing each phase of the request
+    Args:
+        remote (BossRemote) : Remote with the token to use
+        url (str) : URL to GET
+        format_accept (str) : Accepted response format
+        decode (bool) : Also decode the response body (blosc or image) and time it
+    Returns:
+        (requests.Response, dict) : Response, and the duration in seconds of each of the PHASES plus the 'total'
+            from the start of the DNS lookup to the end of the body transfer (not including decoding)
+    """
+    token = remote.token_project
+    headers = {'content-type': 'application/json',
+               'Accept': format_accept,
+               'Authorization': 'Token {0}'.format(token)}
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    phases = dict.fromkeys(PHASES, 0.0)
+
+    start = tick = time.time()
+    addresses = socket.getaddrinfo(parts.hostname, port, 0, socket.SOCK_STREAM)
+    phases['dns'] = time.time() - tick
+
+    # Like socket.create_connection(), try every address in turn and time the attempt that succeeds
+    error = OSError('getaddrinfo returned no addresses')
+    for family, kind, proto, _, address in addresses:
+        tick = time.time()
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.connect(address)
+            break
+        except OSError as e:
+            sock.close()
+            error = e
+    else:
+        raise error
+    phases['connect'] = time.time() - tick
+
+    try:
+        if parts.scheme == 'https':
+            tick = time.time()
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=parts.hostname)
+            phases['tls'] = time.time() - tick
+            conn = http.client.HTTPSConnection(parts.netloc)
+        else:
+            conn = http.client.HTTPConnection(parts.netloc)
+    except Exception:
+        sock.close()
+        raise
+    conn.sock = sock  # Use the already open socket
+
+    try:
+        tick = time.time()
+        conn.request('GET', parts.path + ('?' + parts.query if parts.query else ''), headers=headers)
+        resp = conn.getresponse()
+        phases['ttfb'] = time.time() - tick
+        tick = time.time()
+        content = resp.read()
+        phases['transfer'] = time.time() - tick
+    finally:
+        conn.close()
+    phases['total'] = time.time() - start
+
+    # Build the same response get_obj() returns
+    obj = requests.Response()
+    obj.url = url
+    obj.status_code = resp.status
+    obj.reason = resp.reason
+    obj.headers = requests.structures.CaseInsensitiveDict(resp.getheaders())
+    obj._content = content
+    if decode and obj.ok:
+        tick = time.time()
+        decode_obj(obj)
+        phases['decode'] = time.time() - tick
+    return obj, phases
+
+
+def decode_obj(obj: requests.Response):
+    """Decode the body of a blosc or image response"""
+    content_type = obj.headers.get('Content-Type', '')
+    if content_type.startswith('application/blosc'):
+        import blosc
+        return blosc.decompress(obj.content)
+    elif content_type.startswith('image/'):
+        import matplotlib.image
+        return matplotlib.image.imread(io.BytesIO(obj.content), format=content_type.split('/')[1].split(';')[0])
+    return obj.content
+
+
+def add_phases(result: dict, phases: dict):
+    """Append the phase durations of a timed request to the lists of the same names in a test result"""
+    for phase in PHASES:
+        result.setdefault(phase, []).append(phases[phase])